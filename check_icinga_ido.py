@@ -18,7 +18,19 @@ and service checks in Icinga ido2db Postgres database
 #
 
 import sys
+import os
+import re
+import time
+import select
+import functools
+import heapq
+import tempfile
+import json
+import signal
+import socket
+import SocketServer
 from datetime import datetime
+from decimal import Decimal
 import pytz
 import logging
 import argparse
@@ -26,62 +38,860 @@ from math import ceil
 
 import nagiosplugin
 import psycopg2
+import psycopg2.pool
+import psycopg2.extensions
+from multiprocessing.pool import ThreadPool
+import multiprocessing
 
 import pprint
 
 _log = logging.getLogger('nagiosplugin')
 utc = pytz.utc
 
+# Every query the check runs, by name. Parameters use psycopg2 %s style;
+# the agent PREPAREs each of these once per pooled connection.
+QUERIES = {
+    # both ages in one round trip; each max() can be answered from the end of
+    # an index on status_update_time (see INDEXES) without sorting the table
+    'status': "SELECT EXTRACT(EPOCH FROM (NOW() - (SELECT max(status_update_time) FROM icinga_programstatus))) AS programstatus_age, "
+              "EXTRACT(EPOCH FROM (NOW() - (SELECT max(status_update_time) FROM icinga_servicestatus))) AS last_check_age",
+    # the same two ages for every instance writing to the database. An
+    # instance with no rows at all counts from the epoch, so it goes critical
+    # rather than disappearing.
+    'instances': "SELECT i.instance_id, i.instance_name, "
+                 "EXTRACT(EPOCH FROM (NOW() - COALESCE((SELECT max(p.status_update_time) FROM icinga_programstatus p "
+                 "WHERE p.instance_id = i.instance_id), TIMESTAMP WITH TIME ZONE 'epoch'))) AS programstatus_age, "
+                 "EXTRACT(EPOCH FROM (NOW() - COALESCE((SELECT max(ss.status_update_time) FROM icinga_servicestatus ss "
+                 "WHERE ss.instance_id = i.instance_id), TIMESTAMP WITH TIME ZONE 'epoch'))) AS last_check_age "
+                 "FROM icinga_instances i ORDER BY i.instance_id",
+    # check latency and execution time distribution, computed server-side;
+    # each array is the 50th, 95th and 99th percentile
+    'latency': "SELECT 'service', "
+               "percentile_cont(ARRAY[0.5, 0.95, 0.99]) WITHIN GROUP (ORDER BY latency), max(latency), "
+               "percentile_cont(ARRAY[0.5, 0.95, 0.99]) WITHIN GROUP (ORDER BY execution_time), max(execution_time) "
+               "FROM icinga_servicestatus "
+               "UNION ALL SELECT 'host', "
+               "percentile_cont(ARRAY[0.5, 0.95, 0.99]) WITHIN GROUP (ORDER BY latency), max(latency), "
+               "percentile_cont(ARRAY[0.5, 0.95, 0.99]) WITHIN GROUP (ORDER BY execution_time), max(execution_time) "
+               "FROM icinga_hoststatus",
+}
+
+# services that should have been checked at least N (%s) check intervals
+# ago, stalest first. IDO stores intervals in units of interval_length,
+# which is assumed to be the default 60 seconds.
+STALE_SELECT = ("SELECT ss.service_object_id, o.name1, o.name2, ss.normal_check_interval, "
+                "EXTRACT(EPOCH FROM (NOW() - ss.status_update_time)) AS age "
+                "FROM icinga_servicestatus ss JOIN icinga_objects o ON o.object_id = ss.service_object_id "
+                "WHERE ss.should_be_scheduled = 1 AND o.is_active = 1 "
+                "AND ss.status_update_time < NOW() - ss.normal_check_interval * %s * interval '1 minute'")
+QUERIES.update({
+    # every stale service; streamed through a server-side cursor
+    'stale_scan': STALE_SELECT,
+    # services that can only have gone stale since the last scan (range scan
+    # of the status_update_time index), and a recheck of the ones already stale
+    'stale_since': STALE_SELECT + " AND ss.status_update_time >= to_timestamp(%s)",
+    'stale_recheck': STALE_SELECT + " AND ss.service_object_id = ANY(%s)",
+    # database clock and longest check interval, for the next scan's window
+    'stale_meta': "SELECT EXTRACT(EPOCH FROM NOW()), (SELECT max(normal_check_interval) FROM icinga_servicestatus)",
+})
+
+# tables ido2db writes one row per event to, and their event time column,
+# for measuring write throughput (-T/--throughput)
+THROUGHPUT_TABLES = {
+    'servicechecks': ('icinga_servicechecks', 'end_time'),
+    'statehistory': ('icinga_statehistory', 'state_time'),
+}
+for _name, (_table, _column) in THROUGHPUT_TABLES.items():
+    # rows written in the last %s seconds, age of the newest row (the
+    # epoch if there are none), the check rate the scheduled services
+    # should produce per second, and how long ago the ido2db instance
+    # that checked in least recently last did so
+    QUERIES['throughput_' + _name] = (
+        "SELECT (SELECT count(*) FROM %(table)s WHERE %(column)s >= NOW() - %%s * interval '1 second'), "
+        "EXTRACT(EPOCH FROM (NOW() - COALESCE((SELECT max(%(column)s) FROM %(table)s), 'epoch'))), "
+        "(SELECT sum(1.0 / (normal_check_interval * 60)) FROM icinga_servicestatus "
+        "WHERE should_be_scheduled = 1 AND normal_check_interval > 0), "
+        "(SELECT EXTRACT(EPOCH FROM max(NOW() - last_checkin_time)) FROM "
+        "(SELECT DISTINCT ON (instance_id) last_checkin_time FROM icinga_conninfo "
+        "ORDER BY instance_id, conninfo_id DESC) c)" % {'table': _table, 'column': _column})
+
+# example parameters, so --explain and --benchmark can run the
+# parameterised queries
+EXPLAIN_PARAMS = {
+    'stale_scan': (3,),
+    'stale_since': (3, time.time() - 900),
+    'stale_recheck': (3, [0]),
+    'throughput_servicechecks': (300,),
+    'throughput_statehistory': (300,),
+}
+
+# rows fetched per round trip from a server-side cursor
+STREAM_BATCH = 2000
+
+# always do a full stale scan if the saved watermark is older than this (seconds)
+STALE_RESCAN = 3600
+
+# --benchmark builds its synthetic IDO tables in this schema of the target
+# database, and drops it again afterwards
+BENCH_SCHEMA = 'check_icinga_ido_benchmark'
+
+# the tables and columns the queries use, and how to fill them for %(n)s
+# services on two instances, with a host per ten services. About 1% of
+# services are stale; everything else was updated in the last 2 minutes.
+BENCH_TABLES = [
+    ("CREATE TABLE icinga_instances (instance_id bigserial PRIMARY KEY, instance_name text)",
+     "INSERT INTO icinga_instances (instance_name) VALUES ('default'), ('second')"),
+    ("CREATE TABLE icinga_objects (object_id bigserial PRIMARY KEY, instance_id bigint, objecttype_id integer, "
+     "name1 text, name2 text, is_active integer DEFAULT 1)",
+     "INSERT INTO icinga_objects (instance_id, objecttype_id, name1, name2) "
+     "SELECT 1 + g %% 2, 2, 'host' || (g / 10), 'service' || g FROM generate_series(1, %(n)s) g"),
+    (None,
+     "INSERT INTO icinga_objects (instance_id, objecttype_id, name1) "
+     "SELECT 1 + g %% 2, 1, 'host' || g FROM generate_series(0, %(n)s / 10) g"),
+    ("CREATE TABLE icinga_programstatus (programstatus_id bigserial PRIMARY KEY, instance_id bigint, "
+     "status_update_time timestamptz)",
+     "INSERT INTO icinga_programstatus (instance_id, status_update_time) VALUES (1, NOW()), (2, NOW())"),
+    ("CREATE TABLE icinga_servicestatus (servicestatus_id bigserial PRIMARY KEY, instance_id bigint, "
+     "service_object_id bigint UNIQUE, status_update_time timestamptz, latency double precision, "
+     "execution_time double precision, normal_check_interval double precision, "
+     "should_be_scheduled integer DEFAULT 1)",
+     "INSERT INTO icinga_servicestatus (instance_id, service_object_id, status_update_time, latency, "
+     "execution_time, normal_check_interval) "
+     "SELECT instance_id, object_id, NOW() - CASE WHEN object_id %% 100 = 0 THEN interval '3 hours' "
+     "ELSE random() * interval '2 minutes' END, random() * 2, random() * 5, 5 "
+     "FROM icinga_objects WHERE objecttype_id = 2"),
+    ("CREATE TABLE icinga_hoststatus (hoststatus_id bigserial PRIMARY KEY, instance_id bigint, "
+     "host_object_id bigint UNIQUE, status_update_time timestamptz, latency double precision, "
+     "execution_time double precision)",
+     "INSERT INTO icinga_hoststatus (instance_id, host_object_id, status_update_time, latency, execution_time) "
+     "SELECT instance_id, object_id, NOW() - random() * interval '2 minutes', random(), random() * 3 "
+     "FROM icinga_objects WHERE objecttype_id = 1"),
+    ("CREATE TABLE icinga_servicechecks (servicecheck_id bigserial PRIMARY KEY, instance_id bigint, "
+     "service_object_id bigint, end_time timestamptz)",
+     "INSERT INTO icinga_servicechecks (instance_id, service_object_id, end_time) "
+     "SELECT 1 + g %% 2, g, NOW() - random() * interval '1 hour' FROM generate_series(1, %(n)s) g"),
+    ("CREATE TABLE icinga_statehistory (statehistory_id bigserial PRIMARY KEY, instance_id bigint, "
+     "object_id bigint, state_time timestamptz)",
+     "INSERT INTO icinga_statehistory (instance_id, object_id, state_time) "
+     "SELECT 1 + g %% 2, g, NOW() - random() * interval '1 day' FROM generate_series(1, %(n)s / 10) g"),
+    ("CREATE TABLE icinga_conninfo (conninfo_id bigserial PRIMARY KEY, instance_id bigint, "
+     "last_checkin_time timestamptz)",
+     "INSERT INTO icinga_conninfo (instance_id, last_checkin_time) VALUES (1, NOW()), (2, NOW())"),
+]
+
+# seconds of the --timeout budget kept back, so a query still running can
+# be cancelled and reported before nagiosplugin kills the plugin
+DEADLINE_MARGIN = 1
+
+# NAME=HOST[:PORT][/DBNAME] for -D/--dsn and --dsn-file; NAME defaults to HOST
+DSN_RE = re.compile(r'^(?:(?P<label>[A-Za-z0-9_.-]+)=)?(?P<host>[^:/=\s]+)(?::(?P<port>\d+))?(?:/(?P<db_name>\S+))?$')
+
+# the statistics reported by the 'latency' query, in order
+LATENCY_STATS = ['p50', 'p95', 'p99', 'max']
+
+# indexes the queries above rely on, by table; --explain warns if the
+# query plan falls back to a sequential scan of one of these tables
+INDEXES = {
+    'icinga_servicestatus': [
+        "CREATE INDEX servicestatus_update_time_idx ON icinga_servicestatus (status_update_time);",
+        "CREATE INDEX servicestatus_instance_update_time_idx ON icinga_servicestatus (instance_id, status_update_time);",
+    ],
+    'icinga_servicechecks': [
+        "CREATE INDEX servicechecks_end_time_idx ON icinga_servicechecks (end_time);",
+    ],
+    'icinga_statehistory': [
+        "CREATE INDEX statehistory_state_time_idx ON icinga_statehistory (state_time);",
+    ],
+}
+
+# queries that read all of icinga_servicestatus by design: the stale scan
+# compares each row against its own check interval, and the longest
+# interval has no index to come from
+FULL_SCANS = ['stale_scan', 'stale_meta']
+
+def server_timeouts(budget, lock_timeout=None):
+    """statement_timeout and lock_timeout (ms) that keep the server within budget (seconds)"""
+    statement_ms = max(int(budget * 1000), 1)
+    return statement_ms, min(statement_ms, int((lock_timeout or budget) * 1000))
+
+def make_conn_str(db_host, db_name, db_user, db_pass, db_port, budget=None, lock_timeout=None):
+    """
+    build a psycopg2 connect string; with a budget (seconds), the connect,
+    every statement and (at most lock_timeout of it) every lock wait are
+    limited to it on the server, so nothing outlives the check
+    """
+    conn_str = "dbname='%s' user='%s' host='%s' password='%s' port='%s' application_name='%s'" % (
+        db_name,
+        db_user,
+        db_host,
+        db_pass,
+        db_port,
+        "check_icinga_ido_core.py",
+    )
+    if budget is not None:
+        # libpq takes whole seconds, and treats less than 2 as 2
+        conn_str += " connect_timeout='%d' options='-c statement_timeout=%d -c lock_timeout=%d'" % (
+            (max(int(ceil(budget)), 2),) + server_timeouts(budget, lock_timeout))
+    return conn_str
+
+class DeadlineError(Exception):
+    pass
+
+class DeadlineConnection(psycopg2.extensions.connection):
+    """a psycopg2 connection that wait_deadline stops waiting on at self.deadline"""
+    def __init__(self, dsn, *args, **kwargs):
+        # set before connecting, as the wait callback already runs then
+        self.deadline = kwargs.pop('deadline', None)
+        super(DeadlineConnection, self).__init__(dsn, *args, **kwargs)
+
+def wait_deadline(conn):
+    """
+    psycopg2 wait callback, like psycopg2.extras.wait_select, but once the
+    connection's deadline passes it cancels the running statement (the
+    server then answers with QueryCanceledError), or gives up on a
+    connection still being set up with DeadlineError
+    """
+    deadline = getattr(conn, 'deadline', None)
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                if conn.status == psycopg2.extensions.STATUS_SETUP:
+                    raise DeadlineError("connect did not finish before the deadline")
+                _log.info("deadline passed; cancelling the running query")
+                conn.cancel()
+                deadline = timeout = None
+                continue
+        if state == psycopg2.extensions.POLL_READ:
+            select.select([conn.fileno()], [], [], timeout)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            select.select([], [conn.fileno()], [], timeout)
+        else:
+            raise psycopg2.OperationalError("bad state from poll: %s" % state)
+
+def parse_dsn(spec, db_port, db_name):
+    """
+    split a -D/--dsn spec into (label, host, port, db_name), filling in
+    the default port and database name
+    """
+    m = DSN_RE.match(spec.strip())
+    if m is None:
+        raise nagiosplugin.CheckError('invalid database spec %r; expected NAME=HOST[:PORT][/DBNAME]' % spec)
+    return (m.group('label') or m.group('host'), m.group('host'), m.group('port') or db_port,
+            m.group('db_name') or db_name)
+
+def read_dsn_file(path):
+    """the database specs in a --dsn-file, one per line; blank lines and # comments are skipped"""
+    try:
+        f = open(path)
+        try:
+            lines = f.readlines()
+        finally:
+            f.close()
+    except IOError, e:
+        raise nagiosplugin.CheckError('cannot read database list %s: %s' % (path, e))
+    return [line.split('#', 1)[0].strip() for line in lines if line.split('#', 1)[0].strip()]
+
+def jsonable(value):
+    """convert a value from a result row to something json can encode"""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+class AgentError(Exception):
+    def __init__(self, message, pgcode=None):
+        Exception.__init__(self, message)
+        # the Postgres error code, for errors from the agent's query
+        self.pgcode = pgcode
+
 class IdoStatus(nagiosplugin.Resource):
     """Check age of ido2db programstatus and last service check in postgres database"""
-    def __init__(self, db_host, db_name, db_user, db_pass, db_port=5432):
+    def __init__(self, db_host, db_name, db_user, db_pass, db_port=5432, agent_socket=None,
+                 per_instance=False, latency_stat=None, stale_multiplier=None, stale_top=10,
+                 stale_state=None, throughput=None, window=300, label=None, timeout=None,
+                 lock_timeout=None):
         self.db_host = db_host
         self.db_user = db_user
         self.db_pass = db_pass
         self.db_port = db_port
         self.db_name = db_name
+        self.agent_socket = agent_socket
+        self.per_instance = per_instance
+        self.latency_stat = latency_stat
+        self.stale_multiplier = stale_multiplier
+        self.stale_top = stale_top
+        self.stale_state = stale_state
+        self.stalest = []
+        self.throughput = throughput
+        self.window = window
+        # set when this is one of several databases probed by an IdoFleet
+        self.label = label
+        self.fleet = None
+        self.error = None
+        # the check's time budget (seconds), and where it went
+        self.timeout = timeout
+        self.lock_timeout = lock_timeout
+        self.deadline = None
+        self.started = None
+        self.connect_time = 0.0
+        self.current = None
+        self.conn = None
 
-    def probe(self):
+    def db_id(self):
+        """identifies the database, so an agent can refuse checks meant for another one"""
+        return "%s:%s/%s" % (self.db_host, self.db_port, self.db_name)
+
+    def connect(self):
         _log.info("connecting to Postgres DB %s on %s" % (self.db_name, self.db_host))
+        start = time.time()
+        budget = None
+        if self.deadline is not None:
+            budget = max(self.deadline - start, 0)
         try:
-            conn_str = "dbname='%s' user='%s' host='%s' password='%s' port='%s' application_name='%s'" % (
-                self.db_name,
-                self.db_user,
-                self.db_host,
-                self.db_pass,
-                self.db_port,
-                "check_icinga_ido_core.py",
-            )
+            conn_str = make_conn_str(self.db_host, self.db_name, self.db_user, self.db_pass, self.db_port,
+                                     budget, self.lock_timeout)
             _log.debug("psycopg2 connect string: %s" % conn_str)
-            conn = psycopg2.connect(conn_str)
-        except psycopg2.OperationalError, e:
-            _log.info("got psycopg2.OperationalError: %s" % e.__str__())
+            conn = psycopg2.connect(conn_str, connection_factory=functools.partial(DeadlineConnection,
+                                                                                  deadline=self.deadline))
+        except (psycopg2.OperationalError, DeadlineError), e:
+            _log.info("got %s: %s" % (e.__class__.__name__, e.__str__()))
+            self.connect_time += time.time() - start
+            if self.deadline is not None and time.time() >= self.deadline:
+                raise nagiosplugin.CheckError(self.budget_message(
+                    'connect', "no connection to %s:%s" % (self.db_host, self.db_port)))
             raise nagiosplugin.CheckError(e.__str__())
+        self.connect_time += time.time() - start
         _log.info("connected to database")
-        # these queries come from https://wiki.icinga.org/display/testing/Special+IDOUtils+Queries
-        cur = conn.cursor()
-        _log.debug("got cursor")
-        sql = "SELECT EXTRACT(EPOCH FROM (NOW()-status_update_time)) AS age from icinga_programstatus where (UNIX_TIMESTAMP(status_update_time) > UNIX_TIMESTAMP(NOW())-60);"
-        _log.debug("executing query: %s" % sql)
-        cur.execute(sql)
-        row = cur.fetchone()
-        _log.debug("result: %s" % row)
+        return conn
+
+    def phase_times(self):
+        """how the time since the probe started was spent"""
+        elapsed = time.time() - self.started
+        return "connect %.2fs, queries %.2fs" % (self.connect_time, elapsed - self.connect_time)
+
+    def budget_message(self, phase, error):
+        """say which phase used up the time budget, and how it was spent"""
+        where = ""
+        if phase == 'query' and self.current is not None:
+            where = ", in '%s'" % self.current
+        return "%s phase used up the %ss budget (%s%s): %s" % (
+            phase, self.timeout, self.phase_times(), where, str(error).strip().splitlines()[0])
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def agent_query(self, name, params):
+        """run a named query through the agent listening on agent_socket"""
+        try:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                if self.deadline is not None:
+                    sock.settimeout(max(self.deadline - time.time(), 0.001))
+                sock.connect(self.agent_socket)
+                req = {'db': self.db_id(), 'query': name, 'params': params}
+                if self.deadline is not None:
+                    # the agent limits the query to what is left of ours
+                    req['budget'] = max(self.deadline - time.time(), 0)
+                    req['lock_timeout'] = self.lock_timeout
+                sock.sendall(json.dumps(req) + "\n")
+                f = sock.makefile('r')
+                resp = json.loads(f.readline())
+                f.close()
+            finally:
+                sock.close()
+        except socket.timeout:
+            # no time left to fall back to a direct connection
+            raise DeadlineError("agent on %s did not answer" % self.agent_socket)
+        except (socket.error, ValueError), e:
+            raise AgentError(str(e))
+        if 'error' in resp:
+            if resp.get('pgcode') == '57014':
+                # query_canceled: the budget ran out on the agent, so there
+                # is no time left to fall back to a direct connection
+                raise DeadlineError("agent: %s" % resp['error'])
+            raise AgentError(resp['error'])
+        return resp['rows']
+
+    def query(self, name, params=()):
+        """
+        Run the named query from QUERIES and return all rows, through the
+        agent if one was configured and answers, else over a direct
+        connection that is reused for the rest of this check.
+        """
+        self.current = name
+        if self.agent_socket is not None:
+            try:
+                rows = self.agent_query(name, list(params))
+                _log.debug("agent result for %s: %s" % (name, rows))
+                return rows
+            except AgentError, e:
+                _log.info("agent on %s unavailable (%s); querying directly" % (self.agent_socket, e))
+        if self.conn is None:
+            self.conn = self.connect()
+        cur = self.conn.cursor()
+        _log.debug("executing query: %s" % QUERIES[name])
+        cur.execute(QUERIES[name], params)
+        rows = cur.fetchall()
+        cur.close()
+        _log.debug("result: %s" % rows)
+        return rows
+
+    def explain(self, names):
+        """print the query plan of each named query, and any missing INDEXES"""
+        if self.conn is None:
+            self.conn = self.connect()
+        cur = self.conn.cursor()
+        for name in names:
+            cur.execute("EXPLAIN " + QUERIES[name], EXPLAIN_PARAMS.get(name, ()))
+            plan = "\n".join([row[0] for row in cur.fetchall()])
+            print "Query '%s':\n%s\n\nPlan:\n%s\n" % (name, QUERIES[name], plan)
+            if name in FULL_SCANS:
+                print "(sequential scan expected; no index applies)\n"
+                continue
+            for table, indexes in sorted(INDEXES.items()):
+                if ("Seq Scan on %s " % table) in plan or plan.endswith("Seq Scan on %s" % table):
+                    print "WARNING: sequential scan of %s; the check expects these indexes:\n  %s\n" % (
+                        table, "\n  ".join(indexes))
+        cur.close()
+        self.close()
+
+    def benchmark(self, sizes, iterations=5):
+        """
+        For each number of services in sizes, load synthetic IDO tables
+        (BENCH_TABLES) into BENCH_SCHEMA and print the best of iterations
+        run times of every query in QUERIES, without and with INDEXES.
+        """
+        if self.conn is None:
+            self.conn = self.connect()
+        cur = self.conn.cursor()
+        # a bare ANALYZE would also analyze every table of the real database
+        analyze = ["ANALYZE %s.%s" % (BENCH_SCHEMA, create.split()[2])
+                   for create, load in BENCH_TABLES if create is not None]
+        print "%-26s %9s %14s %14s %8s" % ("query", "services", "no index (ms)", "indexed (ms)", "speedup")
+        try:
+            for n in sizes:
+                cur.execute("DROP SCHEMA IF EXISTS %s CASCADE" % BENCH_SCHEMA)
+                cur.execute("CREATE SCHEMA %s" % BENCH_SCHEMA)
+                cur.execute("SET search_path TO %s" % BENCH_SCHEMA)
+                _log.info("loading %d synthetic services" % n)
+                for create, load in BENCH_TABLES:
+                    if create is not None:
+                        cur.execute(create)
+                    cur.execute(load % {'n': int(n)})
+                for statement in analyze:
+                    cur.execute(statement)
+                times = {}
+                for indexed in (False, True):
+                    if indexed:
+                        for table, indexes in sorted(INDEXES.items()):
+                            for index in indexes:
+                                cur.execute(index)
+                        for statement in analyze:
+                            cur.execute(statement)
+                    for name in sorted(QUERIES):
+                        best = None
+                        for i in range(iterations):
+                            start = time.time()
+                            cur.execute(QUERIES[name], EXPLAIN_PARAMS.get(name, ()))
+                            cur.fetchall()
+                            elapsed = time.time() - start
+                            if best is None or elapsed < best:
+                                best = elapsed
+                        times[(name, indexed)] = best
+                for name in sorted(QUERIES):
+                    print "%-26s %9d %14.2f %14.2f %7.1fx" % (
+                        name, n, times[(name, False)] * 1000, times[(name, True)] * 1000,
+                        times[(name, False)] / max(times[(name, True)], 1e-6))
+                self.conn.rollback()
+        finally:
+            self.conn.rollback()
+            cur.close()
+            self.close()
+
+    def stream(self, name, params=()):
+        """
+        Yield the rows of a named query through a server-side (named)
+        cursor, STREAM_BATCH rows per round trip, so large results never
+        sit in memory at once. Always uses the direct connection.
+        """
+        if self.conn is None:
+            self.conn = self.connect()
+        self.current = name
+        cur = self.conn.cursor(name='%s_cursor' % name)
+        cur.itersize = STREAM_BATCH
+        _log.debug("streaming query: %s %s" % (QUERIES[name], params))
+        cur.execute(QUERIES[name], params)
+        try:
+            while True:
+                rows = cur.fetchmany(STREAM_BATCH)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cur.close()
+
+    def load_stale_state(self):
+        """the watermark saved by the last stale scan, or None"""
+        if self.stale_state is None:
+            return None
+        try:
+            f = open(self.stale_state)
+            try:
+                state = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError), e:
+            _log.info("no usable stale scan state in %s (%s)" % (self.stale_state, e))
+            return None
+        return state
+
+    def save_stale_state(self, state):
+        if self.stale_state is None:
+            return
+        # write and rename, so a concurrent check never reads half a file
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.stale_state)))
+        try:
+            os.write(fd, json.dumps(state))
+        finally:
+            os.close(fd)
+        os.rename(tmp, self.stale_state)
+
+    def probe_stale(self):
+        """
+        Count services not updated for stale_multiplier check intervals and
+        keep the stale_top stalest. With a saved watermark from this
+        database, only services that were already stale or could have gone
+        stale since the last scan are read; otherwise every stale row is
+        streamed. Only the ids of stale services are kept, plus a heap of
+        the stale_top stalest.
+        """
+        mult = self.stale_multiplier
+        db_now, max_interval = self.query('stale_meta')[0]
+        db_now = float(db_now)
+        state = self.load_stale_state()
+        if (state is None or state.get('db') != self.db_id() or state.get('multiplier') != mult or
+                db_now - state.get('scan_time', 0) > STALE_RESCAN):
+            _log.info("full stale service scan")
+            rows = self.stream('stale_scan', (mult,))
+            sources = [rows]
+        else:
+            since = state['scan_time'] - mult * state['max_interval'] * 60
+            _log.info("incremental stale service scan; %d already stale, window from %d" % (
+                len(state['stale']), since))
+            sources = [self.stream('stale_since', (mult, since))]
+            if len(state['stale']) > 0:
+                sources.append(self.stream('stale_recheck', (mult, state['stale'])))
+        stale = set()
+        stalest = []
+        for source in sources:
+            for object_id, host, service, interval, age in source:
+                # the incremental queries can both return a service
+                if object_id in stale:
+                    continue
+                stale.add(object_id)
+                entry = (float(age), host, service, interval)
+                if len(stalest) < self.stale_top:
+                    heapq.heappush(stalest, entry)
+                else:
+                    heapq.heappushpop(stalest, entry)
+        self.stalest = sorted(stalest, reverse=True)
+        self.save_stale_state({
+            'db': self.db_id(),
+            'scan_time': db_now,
+            'multiplier': mult,
+            'max_interval': float(max_interval or 0),
+            'stale': list(stale),
+        })
+        return [nagiosplugin.Metric('stale_services', len(stale), min=0)]
+
+    def probe_status(self):
+        """newest programstatus and servicestatus ages across the whole database"""
+        row = self.query('status')[0]
+        if row[0] is None or row[1] is None:
+            raise nagiosplugin.CheckError('no rows in icinga_programstatus or icinga_servicestatus')
         programstatus_age = ceil(row[0])
-        sql = "select (UNIX_TIMESTAMP(NOW())-UNIX_TIMESTAMP(ss.status_update_time)) as age from icinga_servicestatus ss join icinga_objects os on os.object_id=ss.service_object_id order by status_update_time desc limit 1;"
-        _log.debug("executing query: %s" % sql)
-        cur.execute(sql)
-        row = cur.fetchone()
-        _log.debug("result: %s" % row)
-        last_check_age = ceil(row[0])
+        last_check_age = ceil(row[1])
         return [
             nagiosplugin.Metric('programstatus_age', programstatus_age, uom='s', min=0),
             nagiosplugin.Metric('last_check_age', last_check_age, uom='s', min=0),
             ]
 
+    def probe_instances(self):
+        """one programstatus_age and last_check_age metric per IDO instance"""
+        rows = self.query('instances')
+        if len(rows) == 0:
+            raise nagiosplugin.CheckError('no rows in icinga_instances')
+        metrics = []
+        for instance_id, instance_name, programstatus_age, last_check_age in rows:
+            name = (instance_name or str(instance_id)).replace(' ', '_')
+            _log.info("instance %s (%s): programstatus age %ds, last check age %ds" % (
+                name, instance_id, programstatus_age, last_check_age))
+            metrics.append(nagiosplugin.Metric('programstatus_age_%s' % name, ceil(programstatus_age),
+                                               uom='s', min=0, context='programstatus_age'))
+            metrics.append(nagiosplugin.Metric('last_check_age_%s' % name, ceil(last_check_age),
+                                               uom='s', min=0, context='last_check_age'))
+        return metrics
+
+    def probe_latency(self):
+        """
+        p50/p95/p99/max of host and service check latency and execution
+        time. Only latency_stat is checked against thresholds (contexts
+        'latency' and 'execution_time'); the rest are perfdata only.
+        """
+        metrics = []
+        for row in self.query('latency'):
+            kind = row[0]
+            for field, pcts, maximum in (('latency', row[1], row[2]), ('execution_time', row[3], row[4])):
+                if maximum is None:
+                    # no hosts or services
+                    continue
+                for stat, value in zip(LATENCY_STATS, list(pcts) + [maximum]):
+                    context = 'latency_stats'
+                    if stat == self.latency_stat:
+                        context = field
+                    metrics.append(nagiosplugin.Metric('%s_%s_%s' % (kind, field, stat), round(value, 3),
+                                                       uom='s', min=0, context=context))
+        return metrics
+
+    def probe_throughput(self):
+        """
+        How fast ido2db is writing rows to the throughput table over the
+        last window seconds, against the rate the scheduled services
+        should produce, and how far behind the newest row and the ido2db
+        checkins are.
+        """
+        rows, newest_age, expected_rate, checkin_age = self.query('throughput_' + self.throughput,
+                                                                  (self.window,))[0]
+        rate = float(rows) / self.window
+        # statehistory only gets a row when some state changes, so a quiet,
+        # healthy site has an old newest row; only the checkin shows its lag
+        age_context = 'write_lag'
+        if self.throughput == 'statehistory':
+            age_context = 'throughput_stats'
+        metrics = [
+            nagiosplugin.Metric('%s_rate' % self.throughput, round(rate, 3), min=0,
+                                context='throughput_stats'),
+            nagiosplugin.Metric('%s_age' % self.throughput, round(newest_age), uom='s', min=0,
+                                context=age_context),
+        ]
+        if expected_rate:
+            metrics.append(nagiosplugin.Metric('expected_check_rate', round(expected_rate, 3), min=0,
+                                               context='throughput_stats'))
+            # state changes are not one per check, so only check results
+            # can be compared with the expected rate
+            if self.throughput == 'servicechecks':
+                metrics.append(nagiosplugin.Metric('check_rate_pct', round(100 * rate / float(expected_rate), 1),
+                                                   uom='%', min=0, context='check_rate_pct'))
+        if checkin_age is not None:
+            metrics.append(nagiosplugin.Metric('ido2db_checkin_age', round(checkin_age), uom='s', min=0,
+                                               context='write_lag'))
+        return metrics
+
+    def probe(self):
+        if self.fleet is not None:
+            return self.fleet.collect(self)
+        return self.probe_db()
+
+    def probe_db(self, deadline=None):
+        """
+        Probe this database. deadline (a time.time() value) is where an
+        IdoFleet's shared budget ends; without one the budget starts now.
+        """
+        self.started = time.time()
+        if deadline is not None:
+            self.deadline = deadline
+        elif self.timeout:
+            self.deadline = self.started + max(self.timeout - DEADLINE_MARGIN, 0)
+        try:
+            if self.per_instance:
+                metrics = self.probe_instances()
+            else:
+                metrics = self.probe_status()
+            if self.latency_stat is not None:
+                metrics.extend(self.probe_latency())
+            if self.stale_multiplier is not None:
+                metrics.extend(self.probe_stale())
+            if self.throughput is not None:
+                metrics.extend(self.probe_throughput())
+        except (psycopg2.extensions.QueryCanceledError, DeadlineError), e:
+            # cancelled by wait_deadline or the server's statement_timeout,
+            # or the agent did not answer in time
+            raise nagiosplugin.CheckError(self.budget_message('query', e))
+        except psycopg2.OperationalError, e:
+            if getattr(e, 'pgcode', None) == '55P03':
+                # lock_not_available, from lock_timeout
+                raise nagiosplugin.CheckError("'%s' waited longer than the %ss lock timeout (%s): %s" % (
+                    self.current, self.lock_timeout, self.phase_times(), str(e).strip().splitlines()[0]))
+            raise
+        finally:
+            self.close()
+        return metrics
+
+class IdoFleet(object):
+    """
+    Probes several IDO databases at once. Each database is an IdoStatus
+    resource of the same check; the first one nagiosplugin probes starts
+    all of them on a bounded thread pool, and each then waits for its own
+    metrics until the --timeout deadline. Metric names get the database's
+    label as a suffix; a database that fails or does not answer in time
+    gets db_failed_LABEL=1 and its error in the status line instead.
+    """
+    def __init__(self, members, max_workers=8, timeout=30):
+        self.members = members
+        for member in members:
+            member.fleet = self
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.pending = None
+
+    def start(self):
+        if self.timeout > 0:
+            # one budget for the whole fleet, so members still queued behind
+            # max_workers others do not start a full timeout of their own.
+            # Members cancel their queries DEADLINE_MARGIN before its end;
+            # give them half of that to report it
+            now = time.time()
+            member_deadline = now + max(self.timeout - DEADLINE_MARGIN, 0)
+            self.deadline = now + max(self.timeout - DEADLINE_MARGIN / 2.0, 0)
+        else:
+            member_deadline = self.deadline = None
+        pool = ThreadPool(min(self.max_workers, len(self.members)))
+        self.pending = dict((member.label, pool.apply_async(member.probe_db, (member_deadline,)))
+                            for member in self.members)
+        # workers are daemon threads; never join them, so a hung database
+        # cannot hold the plugin past its deadline
+        pool.close()
+
+    def collect(self, member):
+        if self.pending is None:
+            self.start()
+        try:
+            if self.deadline is None:
+                # a wait with a timeout, unlike one without, can be
+                # interrupted by the nagiosplugin timeout signal
+                metrics = self.pending[member.label].get(sys.maxint)
+            else:
+                metrics = self.pending[member.label].get(max(self.deadline - time.time(), 0))
+        except multiprocessing.TimeoutError:
+            member.error = "no answer within %ss" % self.timeout
+            metrics = []
+        except Exception, e:
+            # one broken database must not hide the results of the others
+            member.error = str(e).strip().splitlines()[0] if str(e).strip() else e.__class__.__name__
+            metrics = []
+        _log.info("database %s: %s" % (member.label, member.error or "%d metrics" % len(metrics)))
+        metrics = [metric.replace(name='%s_%s' % (metric.name, member.label)) for metric in metrics]
+        metrics.append(nagiosplugin.Metric('db_failed_%s' % member.label, int(member.error is not None),
+                                           min=0, max=1, context='db_failed'))
+        return metrics
+
+class IdoAgent(object):
+    """
+    Long-running helper that keeps a small pool of warm connections to the
+    IDO database, with every entry of QUERIES prepared once per
+    connection, and answers checks over a Unix socket so that a normal
+    check run needs no database connection of its own.
+    """
+    def __init__(self, conn_str, db_id, socket_path, minconn=1, maxconn=4):
+        self.conn_str = conn_str
+        self.db_id = db_id
+        self.socket_path = socket_path
+        self.pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, conn_str)
+        self.prepared = set()
+
+    def prepare(self, conn):
+        """PREPARE every query on conn, translating %s parameters to $n"""
+        cur = conn.cursor()
+        for name, sql in QUERIES.items():
+            count = [0]
+            def param(match):
+                count[0] += 1
+                return "$%d" % count[0]
+            cur.execute("PREPARE %s AS %s" % (name, re.sub(r'%s', param, sql).replace('%%', '%')))
+        conn.commit()
+        self.prepared.add(id(conn))
+
+    def execute(self, name, params, budget=None, lock_timeout=None):
+        """
+        Run the prepared query name on a pooled connection. With a budget
+        (seconds), statement_timeout and lock_timeout are set for this
+        query's transaction only, so it cannot outlive the check that asked.
+        """
+        if name not in QUERIES:
+            raise AgentError("unknown query %s" % name)
+        conn = None
+        try:
+            conn = self.pool.getconn()
+            if id(conn) not in self.prepared:
+                self.prepare(conn)
+            cur = conn.cursor()
+            if budget is not None:
+                cur.execute("SET LOCAL statement_timeout = %d; SET LOCAL lock_timeout = %d" %
+                            server_timeouts(budget, lock_timeout))
+            if len(params) > 0:
+                cur.execute("EXECUTE %s (%s)" % (name, ", ".join(["%s"] * len(params))), params)
+            else:
+                cur.execute("EXECUTE %s" % name)
+            rows = [[jsonable(v) for v in row] for row in cur.fetchall()]
+            cur.close()
+            conn.rollback()
+        except psycopg2.pool.PoolError, e:
+            # every pooled connection is busy with another check
+            raise AgentError(str(e).strip())
+        except psycopg2.Error, e:
+            if conn is not None:
+                # connection may be dead; drop it from the pool rather than reuse it
+                self.prepared.discard(id(conn))
+                self.pool.putconn(conn, close=True)
+            raise AgentError(str(e).strip(), getattr(e, 'pgcode', None))
+        self.pool.putconn(conn)
+        return rows
+
+    def serve(self):
+        agent = self
+
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                try:
+                    req = json.loads(self.rfile.readline())
+                    if req.get('db') != agent.db_id:
+                        raise AgentError("agent serves %s, not %s" % (agent.db_id, req.get('db')))
+                    resp = {'rows': agent.execute(req['query'], req.get('params', []),
+                                                  req.get('budget'), req.get('lock_timeout'))}
+                except (AgentError, ValueError, KeyError), e:
+                    resp = {'error': str(e)}
+                    if getattr(e, 'pgcode', None) is not None:
+                        resp['pgcode'] = e.pgcode
+                self.wfile.write(json.dumps(resp) + "\n")
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = SocketServer.ThreadingUnixStreamServer(self.socket_path, Handler)
+        server.daemon_threads = True
+        os.chmod(self.socket_path, 0660)
+        # exit through the finally below, so the socket is removed
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        _log.info("agent for %s listening on %s" % (self.db_id, self.socket_path))
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(self.socket_path)
+
 class LoadSummary(nagiosplugin.Summary):
     """LoadSummary is used to provide custom outputs to the check"""
-    def __init__(self, db_name):
+    def __init__(self, db_name, per_instance=False, fleet=False):
         self.db_name = db_name
+        self.per_instance = per_instance
+        self.fleet = fleet
 
     def _human_time(self, seconds):
         """convert an integer seconds into human-readable hms"""
@@ -103,12 +913,121 @@ class LoadSummary(nagiosplugin.Summary):
         if type(results.most_significant_state) == type(nagiosplugin.state.Unknown):
             # won't have perf values, so special handling
             return results.most_significant[0].hint.splitlines()[0]
-        return "Last Programstatus Update %s ago%s; Last Service Status Update %s ago%s (%s)" % (
+        if self.fleet:
+            return self.fleet_line(results)
+        return "%s (%s)" % (self.db_line(results), self.db_name)
+
+    def db_line(self, results):
+        """the status of one database, from results with unsuffixed metric names"""
+        if self.per_instance:
+            return "%s%s" % (self.instances_line(results), self.extra_lines(results))
+        return "Last Programstatus Update %s ago%s; Last Service Status Update %s ago%s%s" % (
             self._human_time(results['programstatus_age'].metric.value),
             self._state_marker(results['programstatus_age'].state),
             self._human_time(results['last_check_age'].metric.value),
             self._state_marker(results['last_check_age'].state),
-            self.db_name)
+            self.extra_lines(results))
+
+    def db_results(self, results):
+        """
+        split fan-out results by database, into (member, Results) pairs
+        with the label suffix taken off each metric name, worst state first
+        """
+        by_db = {}
+        for result in results:
+            member = result.resource
+            suffix = '_' + member.label
+            if member.label not in by_db:
+                by_db[member.label] = (member, nagiosplugin.Results())
+            by_db[member.label][1].add(result._replace(
+                metric=result.metric.replace(name=result.metric.name[:-len(suffix)])))
+        return sorted(by_db.values(), key=lambda pair: (-int(pair[1].most_significant_state), pair[0].label))
+
+    def fleet_line(self, results):
+        """one '[LABEL] status' clause per database, worst first"""
+        parts = []
+        for member, db_results in self.db_results(results):
+            if member.error is not None:
+                parts.append("[%s] %s%s" % (member.label, member.error,
+                                            self._state_marker(db_results['db_failed'].state)))
+            else:
+                parts.append("[%s] %s" % (member.label, self.db_line(db_results)))
+        return " ".join(parts)
+
+    def extra_lines(self, results):
+        """the clauses of the optional probes, each starting with '; '"""
+        return self.latency_line(results) + self.stale_line(results) + self.throughput_line(results)
+
+    def throughput_line(self, results):
+        """write rate and lag of the throughput table, if measured"""
+        for name in THROUGHPUT_TABLES:
+            if '%s_rate' % name in results:
+                break
+        else:
+            return ""
+        line = "; %s %s rows/s" % (name, results['%s_rate' % name].metric.value)
+        if 'check_rate_pct' in results:
+            result = results['check_rate_pct']
+            line += " (%s%% of expected%s)" % (result.metric.value, self._state_marker(result.state))
+        result = results['%s_age' % name]
+        line += ", newest %s old%s" % (self._human_time(result.metric.value), self._state_marker(result.state))
+        if 'ido2db_checkin_age' in results:
+            result = results['ido2db_checkin_age']
+            line += ", ido2db checkin %s ago%s" % (self._human_time(result.metric.value),
+                                                  self._state_marker(result.state))
+        return line
+
+    def stale_line(self, results):
+        """count of stale services and the stalest one, if scanned"""
+        if 'stale_services' not in results:
+            return ""
+        result = results['stale_services']
+        line = "; %d Stale Services%s" % (result.metric.value, self._state_marker(result.state))
+        if len(result.resource.stalest) > 0:
+            age, host, service, interval = result.resource.stalest[0]
+            line += ", stalest %s/%s %s ago" % (host, service, self._human_time(age))
+        return line
+
+    def latency_line(self, results):
+        """the thresholded latency and execution time statistics, if any"""
+        parts = []
+        for result in results:
+            if result.metric.context in ('latency', 'execution_time'):
+                parts.append("%s %ss%s" % (result.metric.name, result.metric.value,
+                                           self._state_marker(result.state)))
+        if len(parts) == 0:
+            return ""
+        return "; " + ", ".join(parts)
+
+    def instances_line(self, results):
+        """one clause per instance, worst state first"""
+        parts = []
+        for result in results:
+            if result.metric.context != 'programstatus_age':
+                continue
+            name = result.metric.name[len('programstatus_age_'):]
+            last = results['last_check_age_%s' % name]
+            parts.append("%s: Programstatus %s ago%s, Service Status %s ago%s" % (
+                name,
+                self._human_time(result.metric.value),
+                self._state_marker(result.state),
+                self._human_time(last.metric.value),
+                self._state_marker(last.state)))
+        return "; ".join(parts)
+
+    def verbose(self, results):
+        """long output: the stalest services, when a stale scan ran"""
+        lines = super(LoadSummary, self).verbose(results)
+        for result in results:
+            if result.metric is None or result.metric.context != 'stale_services':
+                continue
+            prefix = ""
+            if self.fleet:
+                prefix = "[%s] " % result.resource.label
+            for age, host, service, interval in result.resource.stalest:
+                lines.append("%s%s/%s: last update %s ago (check interval %sm)" % (
+                    prefix, host, service, self._human_time(age), interval))
+        return lines
 
     def ok(self, results):
         return self.status_line(results)
@@ -144,17 +1063,165 @@ def main():
     parser.add_argument('-t', '--timeout', dest='timeout',
                         default=30,
                         help='timeout (in seconds) for the command (Default: 30)')
+    parser.add_argument('--lock-timeout', dest='lock_timeout', type=float,
+                        default=5,
+                        help='longest a query may wait for a table lock, in seconds; queries are also '
+                        'cancelled, on the client and by statement_timeout on the server, when the '
+                        '--timeout budget runs out (Default: 5)')
+    parser.add_argument('-s', '--agent-socket', dest='agent_socket',
+                        help='Unix socket of a check_icinga_ido.py --agent to run queries through; '
+                        'falls back to connecting directly if the agent does not answer')
+    parser.add_argument('--agent', dest='agent', action='store_true', default=False,
+                        help='run as an agent in the foreground, holding pooled connections to the '
+                        'database and answering checks on --agent-socket')
+    parser.add_argument('--agent-pool-size', dest='agent_pool_size', type=int,
+                        default=4,
+                        help='maximum connections the agent keeps open (Default: 4)')
+    parser.add_argument('-i', '--per-instance', dest='per_instance', action='store_true', default=False,
+                        help='check every Icinga instance writing to the database separately, '
+                        'with its own programstatus_age_NAME and last_check_age_NAME metrics')
+    parser.add_argument('-l', '--latency', dest='latency_stat', choices=LATENCY_STATS,
+                        help='also report p50/p95/p99/max host and service check latency and execution '
+                        'time, computed in the database, and check this statistic against the '
+                        'latency and execution time thresholds')
+    parser.add_argument('--latency-warning', dest='latency_warning',
+                        default='30',
+                        help='warning threshold for check latency, in seconds (Default: 30)')
+    parser.add_argument('--latency-critical', dest='latency_critical',
+                        default='60',
+                        help='critical threshold for check latency, in seconds (Default: 60)')
+    parser.add_argument('--exectime-warning', dest='exectime_warning',
+                        default='30',
+                        help='warning threshold for check execution time, in seconds (Default: 30)')
+    parser.add_argument('--exectime-critical', dest='exectime_critical',
+                        default='60',
+                        help='critical threshold for check execution time, in seconds (Default: 60)')
+    parser.add_argument('-S', '--stale', dest='stale_multiplier', type=float,
+                        help='also count services whose last status update is older than this many '
+                        'times their check interval (e.g. 3); the stalest are listed with -v')
+    parser.add_argument('--stale-top', dest='stale_top', type=int,
+                        default=10,
+                        help='number of stalest services to list (Default: 10)')
+    parser.add_argument('--stale-state', dest='stale_state',
+                        help='file to keep the stale scan watermark in; later runs then only read '
+                        'services that changed since the last scan (Default: full scan every run)')
+    parser.add_argument('--stale-warning', dest='stale_warning',
+                        default='0',
+                        help='warning threshold for number of stale services (Default: 0)')
+    parser.add_argument('--stale-critical', dest='stale_critical',
+                        default='100',
+                        help='critical threshold for number of stale services (Default: 100)')
+    parser.add_argument('-T', '--throughput', dest='throughput', choices=sorted(THROUGHPUT_TABLES),
+                        help='also measure how fast ido2db writes rows to icinga_servicechecks or '
+                        'icinga_statehistory, against the check rate of the scheduled services, and how '
+                        'old the newest row and the last ido2db checkin (icinga_conninfo) are')
+    parser.add_argument('--window', dest='window', type=int,
+                        default=300,
+                        help='sliding window for the write rate, in seconds (Default: 300)')
+    parser.add_argument('--rate-warning', dest='rate_warning',
+                        default='80:',
+                        help='warning threshold for servicechecks written, in percent of the expected '
+                        'check rate (Default: 80:)')
+    parser.add_argument('--rate-critical', dest='rate_critical',
+                        default='50:',
+                        help='critical threshold for servicechecks written, in percent of the expected '
+                        'check rate (Default: 50:)')
+    parser.add_argument('--lag-warning', dest='lag_warning',
+                        default='60',
+                        help='warning threshold for the age of the newest servicechecks row (statehistory '
+                        'rows only come with state changes, so their age is not checked) and of the last '
+                        'ido2db checkin, in seconds (Default: 60)')
+    parser.add_argument('--lag-critical', dest='lag_critical',
+                        default='300',
+                        help='critical threshold for the age of the newest servicechecks row and of the '
+                        'last ido2db checkin, in seconds (Default: 300)')
+    parser.add_argument('-D', '--dsn', dest='dsns', action='append', default=[],
+                        help='check this database instead of -H; NAME=HOST[:PORT][/DBNAME], with -p and -n '
+                        'as defaults. Repeat to check several databases concurrently in one run, each '
+                        'with its own _NAME suffixed metrics (the agent socket is not used)')
+    parser.add_argument('--dsn-file', dest='dsn_file',
+                        help='file of -D/--dsn specs to check, one per line')
+    parser.add_argument('--max-workers', dest='max_workers', type=int,
+                        default=8,
+                        help='maximum databases to check at the same time (Default: 8)')
+    parser.add_argument('--benchmark', dest='benchmark', nargs='?', const='10000,100000,1000000',
+                        help='load synthetic IDO data for each of these comma-separated numbers of services '
+                        '(Default: 10000,100000,1000000) into a scratch schema of the database, print how '
+                        'long each query takes with and without the recommended indexes, and exit. '
+                        'Nothing is committed, but this loads up to 1M rows per table into whatever '
+                        'database -H/-n point at, so prefer a copy of the production IDO database.')
+    parser.add_argument('--explain', dest='explain', action='store_true', default=False,
+                        help='print the query plan of the check\'s queries, to confirm the '
+                        'indexes they need exist, and exit')
 
     args = parser.parse_args()
 
-    if not args.hostname:
-        raise nagiosplugin.CheckError('hostname (-H|--hostname) must be provided')
+    if args.dsn_file:
+        args.dsns.extend(read_dsn_file(args.dsn_file))
+
+    if not args.hostname and not args.dsns:
+        raise nagiosplugin.CheckError('hostname (-H|--hostname) or -D|--dsn must be provided')
+
+    if args.benchmark:
+        try:
+            sizes = [int(n) for n in args.benchmark.split(',')]
+        except ValueError:
+            raise nagiosplugin.CheckError('--benchmark takes comma-separated numbers of services')
+        IdoStatus(args.hostname, args.db_name, args.username, args.password, args.port).benchmark(sizes)
+        return
+
+    if args.explain:
+        IdoStatus(args.hostname, args.db_name, args.username, args.password, args.port).explain(
+            ['instances' if args.per_instance else 'status'] + (['latency'] if args.latency_stat else []) +
+            (['stale_meta', 'stale_scan', 'stale_since', 'stale_recheck'] if args.stale_multiplier else []) +
+            (['throughput_' + args.throughput] if args.throughput else []))
+        return
+
+    if args.agent:
+        if not args.agent_socket:
+            raise nagiosplugin.CheckError('--agent requires -s|--agent-socket')
+        logging.basicConfig(level=logging.WARNING - 10 * min(args.verbose, 2))
+        status = IdoStatus(args.hostname, args.db_name, args.username, args.password, args.port)
+        # no query run for a check may outlive the check
+        IdoAgent(make_conn_str(args.hostname, args.db_name, args.username, args.password, args.port,
+                               float(args.timeout) or None, args.lock_timeout),
+                 status.db_id(), args.agent_socket, maxconn=args.agent_pool_size).serve()
+        return
+
+    if args.dsns:
+        members = []
+        for spec in args.dsns:
+            label, host, port, db_name = parse_dsn(spec, args.port, args.db_name)
+            if label in [member.label for member in members]:
+                raise nagiosplugin.CheckError('database name %s given twice' % label)
+            stale_state = args.stale_state and "%s.%s" % (args.stale_state, label)
+            members.append(IdoStatus(host, db_name, args.username, args.password, port, None,
+                                     args.per_instance, args.latency_stat, args.stale_multiplier,
+                                     args.stale_top, stale_state, args.throughput, args.window, label,
+                                     float(args.timeout), args.lock_timeout))
+        IdoFleet(members, args.max_workers, float(args.timeout))
+    else:
+        members = [IdoStatus(args.hostname, args.db_name, args.username, args.password, args.port,
+                             args.agent_socket, args.per_instance, args.latency_stat, args.stale_multiplier,
+                             args.stale_top, args.stale_state, args.throughput, args.window, None,
+                             float(args.timeout), args.lock_timeout)]
+
+    # wait for the server without blocking, so queries can be cancelled at the deadline
+    psycopg2.extensions.set_wait_callback(wait_deadline)
 
-    check = nagiosplugin.Check(
-        IdoStatus(args.hostname, args.db_name, args.username, args.password, args.port),
+    check = nagiosplugin.Check(*members)
+    check.add(
         nagiosplugin.ScalarContext('programstatus_age', args.warning, args.critical),
         nagiosplugin.ScalarContext('last_check_age', args.warning, args.critical),
-        LoadSummary(args.db_name))
+        nagiosplugin.ScalarContext('latency', args.latency_warning, args.latency_critical),
+        nagiosplugin.ScalarContext('execution_time', args.exectime_warning, args.exectime_critical),
+        nagiosplugin.ScalarContext('latency_stats'),
+        nagiosplugin.ScalarContext('stale_services', args.stale_warning, args.stale_critical),
+        nagiosplugin.ScalarContext('check_rate_pct', args.rate_warning, args.rate_critical),
+        nagiosplugin.ScalarContext('write_lag', args.lag_warning, args.lag_critical),
+        nagiosplugin.ScalarContext('throughput_stats'),
+        nagiosplugin.ScalarContext('db_failed', None, '0'),
+        LoadSummary(args.db_name, args.per_instance, len(args.dsns) > 0))
 
     check.main(args.verbose, args.timeout)
 
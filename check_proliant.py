@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 #
-# check_proliant.py - version 1.4
+# check_proliant.py - version 1.5
 #
 # Python script for Nagios
 # check hpasm/hplog fans and power
@@ -9,6 +9,8 @@
 #
 # Note: This uses the thresholds that HPLOG reports to determine OK or CRITICAL for temperatures
 #
+# Perfdata is emitted for every temperature zone (current;warn;threshold) and fan speed (%).
+#
 # This script requires the pexpect module which is Expect implemented in pure python.
 #  it can be obtained from: http://www.noah.org/wiki/Pexpect (or SourceForge.net)
 #
@@ -38,15 +40,54 @@
 #
 #########################################################################################
 
-import time, sys, pexpect, getopt
+import sys, os, time, signal, socket, timeit, glob, hashlib, json, fcntl, mmap, struct, tempfile, subprocess, pexpect, getopt
 
 HPASMCMD = "sudo /sbin/hpasmcli"
 HPASM_PROMPT = "hpasmcli>"
+HPASM_TIMEOUT = 30 # seconds to wait for hpasmcli to answer a command
+HPASMBATCH = ["sudo", "/sbin/hpasmcli", "-s"] # non-interactive mode, commands follow
+HWMON_DIR = "/sys/class/hwmon"
 WARN_TEMP_PCT = 10 # warn if we're within 10% of our temp threshold
+CACHE_DIR = "/var/tmp/check_proliant" # where --cache keeps hpasmcli output
+HISTORY_FILE = CACHE_DIR + "/temp_history" # where --trend keeps past temperatures
+HISTORY_ZONES = 64 # temperature zones the history file has room for
+HISTORY_SLOTS = 256 # readings kept per zone
+TREND_WINDOW = 15 # minutes of history used for the rate of change
+TREND_WARN = 1.0 # warn if a zone heats up this many degrees C per minute
+TREND_CRIT = 2.0 # critical if a zone heats up this many degrees C per minute
+TREND_MIN_SAMPLES = 3 # readings a zone needs in the window, spanning half of it, for a rate
+IML_CURSOR = CACHE_DIR + "/iml_cursor" # last IML entry --type=iml has reported
+COMMAND_FILE = "/var/icinga/rw/icinga.cmd" # external command pipe for --daemon results
+
+# --daemon: default seconds between polls of each check type
+DAEMON_INTERVAL = {
+    'fan': 60,
+    'ps': 60,
+    'temp': 60,
+    'dimm': 300,
+    'proc': 300,
+    'iml': 300,
+}
+
+# default lifetime, in seconds, of each command's cached output. Inventory
+# barely changes, temperatures do.
+CACHE_TTL = {
+    "SHOW FANS": 60,
+    "SHOW POWERSUPPLY": 60,
+    "SHOW TEMP": 30,
+    "SHOW DIMM": 3600,
+    "SHOW SERVER": 3600,
+}
 
-is_CRITICAL = 0
-is_WARNING = 0
-message = ""
+# first line each command prints; used to split hpasmcli -s output that
+# covers several commands back into one buffer per command
+SECTION_MARKERS = {
+    "SHOW FANS": "Fan  Loc",
+    "SHOW POWERSUPPLY": "Power supply #",
+    "SHOW TEMP": "Sensor   Location",
+    "SHOW DIMM": "DIMM Conf",
+    "SHOW SERVER": "System",
+}
 
 # usage info
 def usage():
@@ -55,334 +96,1181 @@ def usage():
     print "checks hplog and returns values for use by Nagios"
     print ""
     print "Usage:"
-    print "check_hplog.py --type=[fan|ps|temp|proc|dimm|all] [--ignore-redundant] [-h | --help]"
-    print "   type:           what information to get - fan, ps, temp, proc, dimm, all"
+    print "check_hplog.py --type=[fan|ps|temp|proc|dimm|all|iml] [--ignore-redundant] [--backend=NAME]"
+    print "               [--iml-cursor=PATH] [--trend] [--trend-warn=RATE] [--trend-crit=RATE] [--trend-window=MINUTES]"
+    print "               [--history-file=PATH] [--replay=FILE] [--cache] [--cache-dir=DIR] [--cache-ttl=TYPE:SECONDS]"
+    print "               [--daemon] [--host=NAME] [--command-file=PATH] [--interval=TYPE:SECONDS]"
+    print "               [--service=TYPE:DESCRIPTION] [--timing] [--trace-file=PATH] [-h | --help]"
+    print "check_hplog.py --benchmark=ROWS"
+    print "   type:           what information to get - fan, ps, temp, proc, dimm, all, or iml"
+    print "                   (critical/caution IML entries added since the last run; the first"
+    print "                   run only records where the log ends. Alerts last one run, so use"
+    print "                   is_volatile or max_check_attempts 1)"
+    print "   --iml-cursor:   where --type=iml remembers the last entry seen (default: " + IML_CURSOR + ")"
+    print "   --backend:      how to read sensors - pexpect (interactive hpasmcli, the default),"
+    print "                   batch (hpasmcli -s, no PTY) or hwmon (fan and temp only, from sysfs;"
+    print "                   hwmon can't see fan redundancy, so that isn't checked)"
+    print "   --replay:       read captured hpasmcli output from a file (- for stdin) instead;"
+    print "                   fixtures/check_proliant has captures from Gen6-Gen10 servers"
+    print "   --benchmark:    time parsing and evaluation of ROWS synthetic sensor rows per type"
+    print "   --trend:        keep temperature history and alert on fast-rising zones (temp, all)"
+    print "   --trend-warn:   warning rate, degrees C per minute (default: " + str(TREND_WARN) + ")"
+    print "   --trend-crit:   critical rate, degrees C per minute (default: " + str(TREND_CRIT) + ")"
+    print "   --trend-window: minutes of history the rate is computed over (default: " + str(TREND_WINDOW) + ");"
+    print "                   no rate until a zone has " + str(TREND_MIN_SAMPLES) + " readings spanning half of it"
+    print "   --history-file: temperature history file (default: " + HISTORY_FILE + ")"
+    print "   --daemon:       stay running (in the foreground), polling each type on its own interval"
+    print "                   and submitting passive results to the Nagios/Icinga command file"
+    print "   --host:         host name to submit results for (default: this host's name)"
+    print "   --command-file: external command file (default: " + COMMAND_FILE + ")"
+    print "   --interval:     poll interval for one type, e.g. temp:30 (repeatable)"
+    print "   --service:      service description for one type, e.g. 'fan:HP Fans' (default: the type)"
+    print "   --timing:       add time_<phase> perfdata: spawn, first_prompt, each command, parse, teardown"
+    print "   --trace-file:   append each run's phase timings to this file as a line of JSON"
+    print "   --cache:        share hpasmcli output between checks through an on-disk cache"
+    print "   --cache-dir:    directory for the cache (default: " + CACHE_DIR + ")"
+    print "   --cache-ttl:    cache lifetime for one type, e.g. temp:30 or dimm:3600 (repeatable)"
     print "   -h --help:      print this usage summary"
 
-def doFans(ignoreRedundant):
-    result = ""
+class HpasmError(Exception):
+    pass
+
+class PhaseTimer:
+    """
+    Wall-clock seconds spent in each phase of a check (spawn, first prompt,
+    each command's round trip, teardown, parsing), in the order first seen.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.order = []
+        self.seconds = {}
+
+    def start(self):
+        return timeit.default_timer()
+
+    def record(self, phase, started):
+        phase = phase.lower().replace(" ", "_")
+        if phase not in self.seconds:
+            self.order.append(phase)
+            self.seconds[phase] = 0.0
+        self.seconds[phase] = self.seconds[phase] + timeit.default_timer() - started
+
+    def perf(self, result):
+        """add each phase to result as time_<phase> perfdata"""
+        for phase in self.order:
+            result.perf("time_" + phase, "%.4f" % self.seconds[phase], "s", "", "", 0)
+
+    def trace(self, path, backend, types):
+        """append this run's phases to path as one line of JSON"""
+        phases = []
+        for phase in self.order:
+            phases.append({"phase": phase, "seconds": round(self.seconds[phase], 6)})
+        record = {"time": int(time.time()), "host": socket.gethostname(), "backend": backend,
+                  "types": types, "phases": phases}
+        try:
+            f = open(path, "a")
+            try:
+                f.write(json.dumps(record) + "\n")
+            finally:
+                f.close()
+        except IOError, e:
+            sys.stderr.write("Unable to write trace file " + path + ": " + str(e) + "\n")
+
+# timings for the current run, recorded by the sessions and runChecks()
+timings = PhaseTimer()
+
+class HpasmSession:
+    """
+    A single interactive hpasmcli process. Every SHOW command is run over
+    the same prompt, so sudo and hpasmcli only start once per check.
+    """
+    def __init__(self, cmd=HPASMCMD):
+        self.cmd = cmd
+        self.child = None
+
+    def open(self):
+        try:
+            started = timings.start()
+            self.child = pexpect.spawn(self.cmd, timeout=HPASM_TIMEOUT)
+            timings.record("spawn", started)
+            started = timings.start()
+            self.child.expect(HPASM_PROMPT)
+            timings.record("first_prompt", started)
+        except (pexpect.ExceptionPexpect, OSError):
+            self.child = None
+            raise HpasmError("Error in pexpect while starting hpasmcli")
+
+    def run(self, command):
+        if self.child is None:
+            self.open()
+        try:
+            started = timings.start()
+            self.child.sendline(command)
+            self.child.expect(HPASM_PROMPT)
+            result = self.child.before
+            timings.record(command, started)
+        except (pexpect.ExceptionPexpect, OSError):
+            raise HpasmError("Error in pexpect while running hpasmcli")
+        if result.strip() == "":
+            raise HpasmError("Error in pexpect while running hpasmcli")
+        return result
+
+    def close(self):
+        if self.child is None:
+            return
+        started = timings.start()
+        try:
+            # wait for hpasmcli to exit on its own instead of sleeping
+            self.child.sendline("EXIT")
+            self.child.expect(pexpect.EOF)
+        except (pexpect.ExceptionPexpect, OSError):
+            pass
+        self.child.close(force=True)
+        self.child = None
+        timings.record("teardown", started)
+
+    def supports(self, command):
+        return True
+
+    def prefetch(self, commands):
+        pass
+
+def splitSections(output, commands):
+    """
+    Split the concatenated output of several commands, run in the given
+    order, at the first line each one prints (SECTION_MARKERS). Returns a
+    dict of command => output, or None if the sections can't be found.
+    """
+    if len(commands) == 1:
+        return {commands[0]: output}
+    lines = output.split("\n")
+    starts = []
+    pos = 0
+    for command in commands:
+        marker = SECTION_MARKERS.get(command)
+        if marker is None:
+            return None
+        while pos < len(lines) and not lines[pos].strip().startswith(marker):
+            pos = pos + 1
+        if pos == len(lines):
+            return None
+        starts.append(pos)
+        pos = pos + 1
+    starts.append(len(lines))
+    sections = {}
+    for i in range(len(commands)):
+        sections[commands[i]] = "\n".join(lines[starts[i]:starts[i+1]])
+    return sections
+
+class HpasmBatch:
+    """
+    Runs hpasmcli non-interactively (hpasmcli -s "SHOW FANS; SHOW TEMP")
+    over a plain pipe. prefetch() fetches several commands in one process;
+    each result is handed out once by run().
+    """
+    def __init__(self, cmd=HPASMBATCH):
+        self.cmd = cmd
+        self.results = {}
+
+    def _exec(self, commands):
+        started = timings.start()
+        try:
+            p = subprocess.Popen(self.cmd + [commands], stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+            out, err = p.communicate()
+        except OSError, e:
+            raise HpasmError("Error running hpasmcli: " + str(e))
+        if p.returncode != 0:
+            raise HpasmError("hpasmcli exited " + str(p.returncode) + ": " + err.strip())
+        if commands.find(";") >= 0:
+            timings.record("batch", started)
+        else:
+            timings.record(commands, started)
+        return out
+
+    def prefetch(self, commands):
+        commands = [c for c in commands if c not in self.results]
+        if len(commands) == 0:
+            return
+        sections = splitSections(self._exec("; ".join(commands)), commands)
+        if sections is None:
+            # couldn't tell the outputs apart; fall back to one run each
+            sections = {}
+            for command in commands:
+                sections[command] = self._exec(command)
+        self.results.update(sections)
+
+    def supports(self, command):
+        return True
+
+    def run(self, command):
+        self.prefetch([command])
+        result = self.results.pop(command)
+        if result.strip() == "":
+            raise HpasmError("Empty output from hpasmcli for " + command)
+        return result
+
+    def close(self):
+        self.results = {}
+
+def readSysfs(path):
+    """return the stripped contents of a sysfs attribute, or None"""
     try:
-        child = pexpect.spawn(HPASMCMD)
-        child.expect(HPASM_PROMPT)
-        child.sendline("SHOW FANS")
-        child.expect(HPASM_PROMPT)
-        result = child.before
-        child.sendline("EXIT")
-        time.sleep(1)
-        child.close()
-        child.close()
-    except pexpect.ExceptionPexpect:
+        f = open(path)
+        try:
+            return f.read().strip()
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return None
+
+class HwmonSession:
+    """
+    Reads temperatures and fans from the kernel hwmon drivers in HWMON_DIR
+    without forking anything, and renders them in the SHOW TEMP / SHOW FANS
+    layout so the usual parsers apply. hwmon has no notion of fan
+    redundancy, so fans report Redundant as N/A, which evalFans() skips.
+    """
+    def __init__(self, hwmon_dir=HWMON_DIR):
+        self.hwmon_dir = hwmon_dir
+
+    def _sensors(self, kind):
+        """yield (label, attribute path prefix) for every sensor of a kind"""
+        for dev in sorted(glob.glob(os.path.join(self.hwmon_dir, "hwmon*"))):
+            name = readSysfs(os.path.join(dev, "name"))
+            if name is None:
+                # older kernels keep the attributes under device/
+                dev = os.path.join(dev, "device")
+                name = readSysfs(os.path.join(dev, "name")) or os.path.basename(dev)
+            inputs = glob.glob(os.path.join(dev, kind + "*_input"))
+            inputs.sort(key=lambda x: int(os.path.basename(x)[len(kind):-len("_input")]))
+            for path in inputs:
+                prefix = path[:-len("_input")]
+                label = readSysfs(prefix + "_label") or name + "_" + os.path.basename(prefix)
+                yield label.replace(" ", "_"), prefix
+
+    def _temps(self):
+        lines = ["Sensor   Location              Temp       Threshold",
+                 "------   --------              ----       ---------"]
+        num = 0
+        for label, prefix in self._sensors("temp"):
+            value = readSysfs(prefix + "_input")
+            if value is None:
+                continue
+            num = num + 1
+            cur = int(value) / 1000
+            limit = readSysfs(prefix + "_crit") or readSysfs(prefix + "_max")
+            if limit is None:
+                threshold = "-"
+            else:
+                limit = int(limit) / 1000
+                threshold = "%dC/%dF" % (limit, limit * 9 / 5 + 32)
+            lines.append("%-8s %-21s %-10s %s" % ("#" + str(num), label,
+                                                  "%dC/%dF" % (cur, cur * 9 / 5 + 32), threshold))
+        return "\n".join(lines) + "\n"
+
+    def _fans(self):
+        lines = ["Fan  Location        Present Speed  of max  Redundant  Partner  Hot-pluggable",
+                 "---  --------        ------- -----  ------  ---------  -------  -------------"]
+        num = 0
+        for label, prefix in self._sensors("fan"):
+            rpm = readSysfs(prefix + "_input")
+            if rpm is None:
+                continue
+            num = num + 1
+            present = "Yes"
+            speed = "NORMAL"
+            if readSysfs(prefix + "_fault") == "1" or int(rpm) == 0:
+                # stopped: report it failed, as hpasmcli would (CRITICAL)
+                present = "FAILED"
+            elif readSysfs(prefix + "_alarm") == "1":
+                speed = "ALARM"
+            lines.append("%-4s %-15s %-7s %-6s %-7s %-10s %-8s %s" % ("#" + str(num), label, present,
+                                                                      speed, "-", "N/A", "-", "-"))
+        return "\n".join(lines) + "\n"
+
+    def supports(self, command):
+        return command in ("SHOW TEMP", "SHOW FANS")
+
+    def run(self, command):
+        started = timings.start()
+        if command == "SHOW TEMP":
+            result = self._temps()
+        elif command == "SHOW FANS":
+            result = self._fans()
+        else:
+            raise HpasmError("hwmon backend cannot run " + command)
+        timings.record(command, started)
+        return result
+
+    def prefetch(self, commands):
         pass
-    except exceptions.OSError:
+
+    def close(self):
         pass
-    
-    if result.strip() == "":
-        print "UNKNOWN: Error in pexpect while running hpasmcli"
-        sys.exit(3)
-    lines = result.split("\n")
-
-    # variables to hold state
-    total_fans = 0
-    fans_missing = 0
-    global is_CRITICAL
-    global is_WARNING
-    global message
-    test_ok = 1
-    
-    for line in lines:
+
+class ReplaySession:
+    """
+    Serves previously captured hpasmcli output instead of running it, so
+    the parsers can be exercised away from the hardware. The capture is
+    either an interactive transcript, where each command follows a
+    "hpasmcli>" prompt, or hpasmcli -s output for the commands checked.
+    A path of "-" reads the capture from stdin.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.content = None
+        self.results = {}
+        self.split = 0
+
+    def _load(self):
+        if self.content is not None:
+            return
+        try:
+            if self.path == "-":
+                self.content = sys.stdin.read()
+            else:
+                f = open(self.path)
+                try:
+                    self.content = f.read()
+                finally:
+                    f.close()
+        except IOError, e:
+            raise HpasmError("Unable to read replay file: " + str(e))
+        current = None
+        for line in self.content.split("\n"):
+            if line.strip().startswith(HPASM_PROMPT):
+                current = " ".join(line.strip()[len(HPASM_PROMPT):].split()).upper()
+                if current == "":
+                    current = None
+                else:
+                    self.results[current] = ""
+            elif current is not None:
+                self.results[current] = self.results[current] + line + "\n"
+
+    def prefetch(self, commands):
+        self._load()
+        if len(self.results) == 0 and self.split == 0:
+            # no prompts in the capture, so treat it as hpasmcli -s output
+            self.split = 1
+            sections = splitSections(self.content, commands)
+            if sections is not None:
+                self.results.update(sections)
+
+    def supports(self, command):
+        return True
+
+    def run(self, command):
+        self.prefetch([command])
+        if self.results.get(command, "").strip() == "":
+            raise HpasmError("No output for " + command + " in replay file " + self.path)
+        return self.results[command]
+
+    def close(self):
+        pass
+
+class CachedSession:
+    """
+    Wraps a session, keeping the raw output of each command in cache_dir
+    for that command's TTL. All access happens under an exclusive lock, so
+    checks that start at the same moment wait for one hpasmcli run and then
+    read its output, instead of each spawning their own. When any command
+    has to be refreshed, every other stale command the backend supports is
+    refreshed over the same session too, on a best-effort basis: only the
+    requested command can fail the check.
+    """
+    def __init__(self, session, cache_dir=CACHE_DIR, ttls=CACHE_TTL):
+        self.session = session
+        self.cache_dir = cache_dir
+        self.ttls = ttls
+        self.lockfile = None
+
+    def _path(self, command):
+        return os.path.join(self.cache_dir, command.lower().replace(" ", "_"))
+
+    def _lock(self):
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir, 0700)
+            except OSError:
+                if not os.path.isdir(self.cache_dir):
+                    raise HpasmError("Unable to create cache directory " + self.cache_dir)
+        try:
+            self.lockfile = open(os.path.join(self.cache_dir, "lock"), "a")
+            started = timings.start()
+            fcntl.flock(self.lockfile, fcntl.LOCK_EX)
+            timings.record("cache_lock", started)
+        except IOError:
+            raise HpasmError("Unable to lock cache directory " + self.cache_dir)
+
+    def _unlock(self):
+        fcntl.flock(self.lockfile, fcntl.LOCK_UN)
+        self.lockfile.close()
+        self.lockfile = None
+
+    def _read(self, command):
+        """return cached output for command, or None if missing or expired"""
+        path = self._path(command)
+        try:
+            if time.time() - os.stat(path).st_mtime >= self.ttls.get(command, 0):
+                return None
+            f = open(path)
+            try:
+                return f.read()
+            finally:
+                f.close()
+        except (IOError, OSError):
+            return None
+
+    def _write(self, command, result):
+        # write to a temp file and rename, so readers never see a partial file
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir)
+        try:
+            os.write(fd, result)
+        finally:
+            os.close(fd)
+        os.rename(tmp, self._path(command))
+
+    def run(self, command):
+        self._lock()
+        try:
+            result = self._read(command)
+            if result is not None:
+                return result
+            # hpasmcli has to run anyway; refresh everything that's stale
+            stale = [command]
+            for other in self.ttls:
+                if other != command and self.ttls[other] > 0 and self.session.supports(other) \
+                        and self._read(other) is None:
+                    stale.append(other)
+            try:
+                self.session.prefetch(stale)
+            except HpasmError:
+                # run() fetches the requested command on its own; skip the rest
+                stale = [command]
+            result = self.session.run(command)
+            self._write(command, result)
+            for other in stale[1:]:
+                try:
+                    output = self.session.run(other)
+                except HpasmError:
+                    continue
+                self._write(other, output)
+            return result
+        finally:
+            self._unlock()
+
+    def supports(self, command):
+        return self.session.supports(command)
+
+    def prefetch(self, commands):
+        pass
+
+    def close(self):
+        self.session.close()
+
+class FanReading(object):
+    """one row of SHOW FANS"""
+    __slots__ = ('fan', 'location', 'present', 'speed', 'pct', 'redundant')
+
+    def __init__(self, fan, location, present, speed, pct, redundant):
+        self.fan = fan
+        self.location = location
+        self.present = present
+        self.speed = speed
+        self.pct = pct # int percent of max speed, or None
+        self.redundant = redundant
+
+class TempReading(object):
+    """one row of SHOW TEMP that has a current temperature"""
+    __slots__ = ('sensor', 'zone', 'temp', 'threshold')
+
+    def __init__(self, sensor, zone, temp, threshold):
+        self.sensor = sensor
+        self.zone = zone
+        self.temp = temp # int degrees C
+        self.threshold = threshold # int degrees C, or None for "-"
+
+class PsuStatus(object):
+    """one power supply from SHOW POWERSUPPLY"""
+    __slots__ = ('psu', 'present', 'redundant', 'condition')
+
+    def __init__(self, psu):
+        self.psu = psu
+        self.present = None
+        self.redundant = None
+        self.condition = None
+
+class DimmStatus(object):
+    """one module from SHOW DIMM"""
+    __slots__ = ('processor', 'module', 'present', 'status')
+
+    def __init__(self, processor, module):
+        self.processor = processor
+        self.module = module
+        self.present = None
+        self.status = None
+
+class ProcStatus(object):
+    """one processor from SHOW SERVER"""
+    __slots__ = ('proc', 'status')
+
+    def __init__(self, proc):
+        self.proc = proc
+        self.status = None
+
+class CheckResult(object):
+    """accumulated state, status text and perfdata for one check run"""
+    def __init__(self):
+        self.critical = 0
+        self.warning = 0
+        self.unknown = 0
+        self.message = ""
+        self.perfdata = []
+
+    def perf(self, label, value, uom="", warn="", crit="", minimum="", maximum=""):
+        if " " in label or "=" in label:
+            label = "'" + label + "'"
+        values = [str(value) + uom] + [str(x) for x in (warn, crit, minimum, maximum)]
+        self.perfdata.append(label + "=" + ";".join(values).rstrip(";"))
+
+    def code(self):
+        if self.unknown != 0:
+            return 3
+        if self.critical != 0:
+            return 2
+        if self.warning != 0:
+            return 1
+        return 0
+
+    def output(self):
+        text = ("OK: ", "WARNING: ", "CRITICAL: ", "UNKNOWN: ")[self.code()] + self.message
+        if len(self.perfdata) > 0:
+            text = text + " | " + " ".join(self.perfdata)
+        return text
+
+def parseFans(output):
+    readings = []
+    for line in output.split("\n"):
         # skip over blank lines or command echo
         if line.strip() == "" or line.strip() == "SHOW FANS":
             continue
         # skip over formatting lines and column headings
         if line[:8] == "Fan  Loc" or line[:8] == "---  ---":
             continue
-        
-        # THIS IS AN IMPORTANT LINE
-        total_fans = total_fans + 1
         fields = line.split() # get the fields
-        fanNum = fields[0]
-        # is_present
-        if fields[2] != "Yes":
-            fans_missing = fans_missing + 1
-            is_CRITICAL = 1
-            test_ok=0
-            message = message + "Fan " + fanNum + " Status=" + fields[2] + ". "
-        # speed
-        if fields[3] != "NORMAL":
-            is_WARNING = 1
-            test_ok=0
-            message = message + "Fan " + fanNum + " Speed=" + fields[3] + ". "
-        # is redundant
-        if ignoreRedundant == 0 and fields[5] != "Yes":
-            is_CRITICAL = 1
-            test_ok=0
-            message = message + "Fan " + fanNum + " Redundant=" + fields[5] + ". "
-            
-    if test_ok == 1:
-        message = message + str(total_fans) + " fans normal."
-    return test_ok
-
-def doPower(ignoreRedundant):
-    result = ""
-    try:
-        child = pexpect.spawn(HPASMCMD)
-        child.expect(HPASM_PROMPT)
-        child.sendline("SHOW POWERSUPPLY")
-        child.expect(HPASM_PROMPT)
-        result = child.before
-        child.sendline("EXIT")
-        time.sleep(1)
-        child.close()
-        child.close()
-    except pexpect.ExceptionPexpect:
-        pass
-    except exceptions.OSError:
-        pass
-    
-    if result.strip() == "":
-        print "UNKNOWN: Error in pexpect while running hpasmcli"
-        sys.exit(3)
-    lines = result.split("\n")
+        pct = None
+        if fields[4][-1:] == "%":
+            pct = int(fields[4][:-1])
+        readings.append(FanReading(fields[0], fields[1], fields[2], fields[3], pct, fields[5]))
+    return readings
 
-    # variables to hold state
-    global is_CRITICAL
-    global is_WARNING
-    global message
-    test_ok = 1
-    ps_num = ""
-    num_psus = 0
-    
-    for line in lines:
+def parsePower(output):
+    psus = []
+    for line in output.split("\n"):
         # skip over blank lines or command echo
         if line.strip() == "" or line.strip() == "SHOW POWERSUPPLY":
             continue
-        
-        # THIS IS AN IMPORTANT LINE
         if line[:14] == "Power supply #":
             # we're starting a new power supply
-            if ps_num == "":
-                # first power supply, just update ps_num
-                ps_num = line[line.find("#")+1:].strip()
-                num_psus = num_psus+1
-            elif ps_num != "":
-                # update ps_num
-                ps_num = line[line.find("#")+1:].strip()
-                num_psus = num_psus+1
-        else:
-            # just a line with info about current ps
-            parts = line.strip().split(":")
-            if parts[0].strip() == "Present":
-                if parts[1].strip() != "Yes":
-                    is_CRITICAL = 1
-                    test_ok = 0
-                    message = message + "PSU #" + ps_num + " Not Present. "
-            elif parts[0].strip() == "Redundant":
-                if parts[1].strip() != "Yes" and ignoreRedundant != 1:
-                    is_CRITICAL = 1
-                    test_ok = 0
-                    message = message + "PSU #" + ps_num + " Not Redundant. "
-            elif parts[0].strip() == "Condition":
-                if parts[1].strip() != "Ok":
-                    message = message + "PSU #" + ps_num + " condition is '" + parts[1].strip() + "'. "
-                    is_CRITICAL = 1
-                    test_ok = 0
-    
-    if test_ok == 1 and ignoreRedundant == 1:
-        message = message + " ALL (" + str(num_psus) + ") PSUs OK."
-    elif test_ok == 1:
-        message = message + " ALL (" + str(num_psus) + ") PSUs OK and Redundant."
-    return test_ok
-                
-def doTemp(ignoreRedundant):
-    try:
-        child = pexpect.spawn(HPASMCMD)
-        child.expect(HPASM_PROMPT)
-        child.sendline("SHOW TEMP")
-        child.expect(HPASM_PROMPT)
-        result = child.before
-        child.sendline("EXIT")
-        time.sleep(1)
-        child.close()
-        child.close()
-    except pexpect.ExceptionPexpect:
-        pass
-    except exceptions.OSError:
-        pass
-    
-    if result.strip() == "":
-        print "UNKNOWN: Error in pexpect while running hpasmcli"
-        sys.exit(3)
-    lines = result.split("\n")
+            psus.append(PsuStatus(line[line.find("#")+1:].strip()))
+            continue
+        if len(psus) == 0:
+            continue
+        # just a line with info about current ps
+        parts = line.strip().split(":")
+        if len(parts) < 2:
+            continue
+        key = parts[0].strip()
+        if key == "Present":
+            psus[-1].present = parts[1].strip()
+        elif key == "Redundant":
+            psus[-1].redundant = parts[1].strip()
+        elif key == "Condition":
+            psus[-1].condition = parts[1].strip()
+    return psus
 
-    # variables to hold state
-    global is_CRITICAL
-    global is_WARNING
-    global message
-    test_ok = 1
-    num_temps = 0
-    
-    for line in lines:
+def parseTemp(output):
+    readings = []
+    for line in output.split("\n"):
         # skip over blank lines or command echo
         if line.strip() == "" or line.strip() == "SHOW TEMP":
             continue
         # skip over formatting lines and column headings
         if line[:17] == "Sensor   Location" or line[:17] == "------   --------":
             continue
-
         fields = line.split() # get the fields
-
         # skip anything that doesn't give a current temp
         if fields[2].strip() == "-":
             continue
+        temp = int(fields[2][:fields[2].find("C")])
+        threshold = None
+        if fields[3].strip() != "-":
+            threshold = int(fields[3][:fields[3].find("C")])
+        readings.append(TempReading(fields[0].lstrip("#"), fields[1].strip(), temp, threshold))
+    return readings
 
-        num_temps = num_temps + 1
+def parseProc(output):
+    procs = []
+    inProc = 0
+    for line in output.split("\n"):
+        # skip over blank lines or command echo
+        if line.strip() == "" or line.strip() == "SHOW SERVER":
+            continue
+        if line[:10] == "Processor:":
+            procs.append(ProcStatus(line[line.find(":")+1:].strip()))
+            inProc = 1
+        elif inProc == 1:
+            if line[:15] == "Processor total":
+                # we're out of the processor section
+                inProc = 0
+                continue
+            fields = line.split(":")
+            if fields[0].strip() == "Status":
+                procs[-1].status = fields[1].strip()
+    return procs
 
-        zoneName = fields[1].strip()
-        curTemp = fields[2]
-        curTemp = int(curTemp[:curTemp.find("C")])
-        if fields[3].strip() == "-":
-            # if the threshold field is "-", we can't check anything here, so move along
+def parseDIMM(output):
+    dimms = []
+    processor = ""
+    for line in output.split("\n"):
+        # skip over blank lines or command echo
+        if line.strip() == "" or line.strip() == "SHOW DIMM":
+            continue
+        if line[:9] == "DIMM Conf" or line[:9] == "---------":
+            continue
+        fields = line.split(":")
+        if len(fields) < 2:
             continue
-        threshold = fields[3]
-        threshold = int(threshold[:threshold.find("C")])
-        warn = float(threshold) - (float(threshold) * ( 1.0 / float(WARN_TEMP_PCT)))
-        if curTemp >= threshold:
-            message = message + zoneName + "=" + str(curTemp) + "C/" + str(threshold) + "C "
-            is_CRITICAL = 1
+        key = fields[0].strip()
+        if key[:9] == "Processor":
+            processor = fields[1].strip()
+        elif key[:6] == "Module":
+            # start a new module
+            dimms.append(DimmStatus(processor, fields[1].strip()))
+        elif len(dimms) == 0:
+            continue
+        elif key == "Present":
+            dimms[-1].present = fields[1].strip()
+        elif key == "Status":
+            dimms[-1].status = fields[1].strip()
+    return dimms
+
+def evalFans(readings, ignoreRedundant, result):
+    test_ok = 1
+    for fan in readings:
+        # is_present
+        if fan.present != "Yes":
+            result.critical = 1
+            test_ok = 0
+            result.message = result.message + "Fan " + fan.fan + " Status=" + fan.present + ". "
+        # speed
+        if fan.speed != "NORMAL":
+            result.warning = 1
             test_ok = 0
-        elif curTemp >= warn:
-            message = message + zoneName + "=" + str(curTemp) + "C/" + str(threshold) + "C "
-            is_WARNING = 1
+            result.message = result.message + "Fan " + fan.fan + " Speed=" + fan.speed + ". "
+        # is redundant (N/A where the backend can't tell, e.g. hwmon)
+        if ignoreRedundant == 0 and fan.redundant not in ("Yes", "N/A"):
+            result.critical = 1
             test_ok = 0
-
+            result.message = result.message + "Fan " + fan.fan + " Redundant=" + fan.redundant + ". "
+        if fan.pct is not None:
+            result.perf("fan" + fan.fan.lstrip("#") + "_" + fan.location, fan.pct, "%", "", "", 0, 100)
     if test_ok == 1:
-        message = message + " ALL (" + str(num_temps) + ") Temp Zones OK."
+        result.message = result.message + str(len(readings)) + " fans normal."
     return test_ok
 
-def doProc(ignoreRedundant):
-    try:
-        child = pexpect.spawn(HPASMCMD)
-        child.expect(HPASM_PROMPT)
-        child.sendline("SHOW SERVER")
-        child.expect(HPASM_PROMPT)
-        result = child.before
-        child.sendline("EXIT")
-        time.sleep(1)
-        child.close()
-        child.close()
-    except pexpect.ExceptionPexpect:
-        pass
-    except exceptions.OSError:
-        pass
-    
-    if result.strip() == "":
-        print "UNKNOWN: Error in pexpect while running hpasmcli"
-        sys.exit(3)
-    lines = result.split("\n")
-
-    # variables to hold state
-    global is_CRITICAL
-    global is_WARNING
-    global message
-    proc_num = ""
-    num_procs = 0
+def evalPower(psus, ignoreRedundant, result):
     test_ok = 1
-    
-    for line in lines:
-        # skip over blank lines or command echo
-        if line.strip() == "" or line.strip() == "SHOW SERVER":
+    for psu in psus:
+        if psu.present is not None and psu.present != "Yes":
+            result.critical = 1
+            test_ok = 0
+            result.message = result.message + "PSU #" + psu.psu + " Not Present. "
+        if psu.redundant is not None and psu.redundant != "Yes" and ignoreRedundant != 1:
+            result.critical = 1
+            test_ok = 0
+            result.message = result.message + "PSU #" + psu.psu + " Not Redundant. "
+        if psu.condition is not None and psu.condition != "Ok":
+            result.critical = 1
+            test_ok = 0
+            result.message = result.message + "PSU #" + psu.psu + " condition is '" + psu.condition + "'. "
+    if test_ok == 1 and ignoreRedundant == 1:
+        result.message = result.message + " ALL (" + str(len(psus)) + ") PSUs OK."
+    elif test_ok == 1:
+        result.message = result.message + " ALL (" + str(len(psus)) + ") PSUs OK and Redundant."
+    return test_ok
+
+def tempWarn(threshold):
+    """the warning level for a zone: WARN_TEMP_PCT percent below its threshold"""
+    return float(threshold) - (float(threshold) * (float(WARN_TEMP_PCT) / 100.0))
+
+def evalTemp(readings, ignoreRedundant, result, trend=None):
+    """trend, if given, is (TempHistory, window, warn rate, crit rate) for evalTempTrend()"""
+    test_ok = 1
+    for r in readings:
+        label = "temp" + r.sensor + "_" + r.zone
+        if r.threshold is None:
+            # if the threshold field is "-", we can't check anything here, so just graph it
+            result.perf(label, r.temp)
             continue
-        
-        # THIS IS AN IMPORTANT LINE
-        if line[:10] == "Processor:":
-            proc_num = line[line.find(":")+1:].strip()
-            num_procs = num_procs + 1
-        elif proc_num != "":
-            if line[:15] == "Processor total":
-                # we're out of the processor section
-                proc_num = ""
-            # handle the lines
-            fields = line.split(":")
-            if fields[0].strip() == "Status":
-                if fields[1].strip() != "Ok":
-                    message = message + "Processor " + proc_num + " " + fields[1].strip() + " "
-                    is_CRITICAL = 1
-                    test_ok = 0
-                    
+        warn = tempWarn(r.threshold)
+        result.perf(label, r.temp, "", "%g" % warn, r.threshold)
+        if r.temp >= r.threshold:
+            result.message = result.message + r.zone + "=" + str(r.temp) + "C/" + str(r.threshold) + "C "
+            result.critical = 1
+            test_ok = 0
+        elif r.temp >= warn:
+            result.message = result.message + r.zone + "=" + str(r.temp) + "C/" + str(r.threshold) + "C "
+            result.warning = 1
+            test_ok = 0
+    if trend is not None:
+        history, window, rateWarn, rateCrit = trend
+        if evalTempTrend(readings, history, window, rateWarn, rateCrit, result) == 0:
+            test_ok = 0
     if test_ok == 1:
-        message = message + " ALL (" + str(num_procs) + ") processors Ok."
+        result.message = result.message + " ALL (" + str(len(readings)) + ") Temp Zones OK."
     return test_ok
 
-def doDIMM(ignoreRedundant):
-    try:
-        child = pexpect.spawn(HPASMCMD)
-        child.expect(HPASM_PROMPT)
-        child.sendline("SHOW DIMM")
-        child.expect(HPASM_PROMPT)
-        result = child.before
-        child.sendline("EXIT")
-        time.sleep(1)
-        child.close()
-        child.close()
-    except pexpect.ExceptionPexpect:
-        pass
-    except exceptions.OSError:
-        pass
-    
-    if result.strip() == "":
-        print "UNKNOWN: Error in pexpect while running hpasmcli"
-        sys.exit(3)
-    lines = result.split("\n")
+def evalProc(procs, ignoreRedundant, result):
+    test_ok = 1
+    for proc in procs:
+        if proc.status is not None and proc.status != "Ok":
+            result.message = result.message + "Processor " + proc.proc + " " + proc.status + " "
+            result.critical = 1
+            test_ok = 0
+    if test_ok == 1:
+        result.message = result.message + " ALL (" + str(len(procs)) + ") processors Ok."
+    return test_ok
 
-    # variables to hold state
-    global is_CRITICAL
-    global is_WARNING
-    global message
+def evalDIMM(dimms, ignoreRedundant, result):
     test_ok = 1
-    dimm_num = ""
-    num_dimms = 0
-    present = ""
-    status = ""
-    
-    for line in lines:
-        # skip over blank lines or command echo
-        if line.strip() == "" or line.strip() == "SHOW DIMM":
+    for dimm in dimms:
+        if dimm.status != "Ok" and dimm.status != "N/A":
+            result.message = result.message + "DIMM " + dimm.processor + "/" + dimm.module + " Status: " + str(dimm.status) + ". "
+            result.critical = 1
+            test_ok = 0
+    if test_ok == 1:
+        result.message = result.message + " ALL (" + str(len(dimms)) + ") DIMMs Ok."
+    return test_ok
+
+class TempHistory:
+    """
+    Per-zone temperature history in a fixed-size, memory-mapped file. Each
+    zone owns a ring buffer of HISTORY_SLOTS (time, temp) entries, so an
+    update is a single in-place write and reading a window never touches
+    more than one zone's slots.
+    """
+    HEADER = struct.Struct("<4sIII") # magic, version, zones, slots
+    ZONE = struct.Struct("<32sII") # key, next slot to write, entries used
+    ENTRY = struct.Struct("<dd") # unix time, degrees C
+    MAGIC = "HPTH"
+
+    def __init__(self, path=HISTORY_FILE, zones=HISTORY_ZONES, slots=HISTORY_SLOTS):
+        self.path = path
+        self.zones = zones
+        self.slots = slots
+        self.zone_size = self.ZONE.size + slots * self.ENTRY.size
+        self.size = self.HEADER.size + zones * self.zone_size
+        self.f = None
+        self.map = None
+        self.offsets = {}
+
+    def open(self):
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path), 0700)
+            self.f = os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0600), "r+b")
+            fcntl.flock(self.f, fcntl.LOCK_EX)
+            self.f.seek(0)
+            header = self.f.read(self.HEADER.size)
+            if len(header) != self.HEADER.size or self.HEADER.unpack(header) != (self.MAGIC, 1, self.zones, self.slots):
+                # new file, or laid out for different sizes; start over
+                self.f.truncate(0)
+                self.f.truncate(self.size)
+                self.f.seek(0)
+                self.f.write(self.HEADER.pack(self.MAGIC, 1, self.zones, self.slots))
+                self.f.flush()
+            self.map = mmap.mmap(self.f.fileno(), self.size)
+        except (IOError, OSError, EnvironmentError), e:
+            self.close()
+            raise HpasmError("Unable to open temperature history " + self.path + ": " + str(e))
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.f is not None:
+            fcntl.flock(self.f, fcntl.LOCK_UN)
+            self.f.close()
+            self.f = None
+
+    def _zone(self, key):
+        """offset of the zone record for key, claiming a free one if needed"""
+        if key in self.offsets:
+            return self.offsets[key]
+        name = key[:self.ZONE.size - 8]
+        for i in range(self.zones):
+            offset = self.HEADER.size + i * self.zone_size
+            stored = self.ZONE.unpack_from(self.map, offset)[0].rstrip("\0")
+            if stored == name or stored == "":
+                if stored == "":
+                    self.ZONE.pack_into(self.map, offset, name, 0, 0)
+                self.offsets[key] = offset
+                return offset
+        raise HpasmError("Temperature history " + self.path + " is full; raise HISTORY_ZONES")
+
+    def append(self, key, when, temp):
+        offset = self._zone(key)
+        name, head, used = self.ZONE.unpack_from(self.map, offset)
+        self.ENTRY.pack_into(self.map, offset + self.ZONE.size + head * self.ENTRY.size, when, temp)
+        self.ZONE.pack_into(self.map, offset, name, (head + 1) % self.slots, min(used + 1, self.slots))
+
+    def window(self, key, since):
+        """(time, temp) entries for key no older than since, newest first"""
+        offset = self._zone(key)
+        name, head, used = self.ZONE.unpack_from(self.map, offset)
+        entries = []
+        for i in range(used):
+            slot = (head - 1 - i) % self.slots
+            when, temp = self.ENTRY.unpack_from(self.map, offset + self.ZONE.size + slot * self.ENTRY.size)
+            if when < since:
+                break
+            entries.append((when, temp))
+        return entries
+
+def tempRate(entries):
+    """least-squares slope of (time, temp) entries, in degrees C per minute"""
+    if len(entries) < 2:
+        return None
+    n = float(len(entries))
+    mean_t = sum([e[0] for e in entries]) / n
+    mean_c = sum([e[1] for e in entries]) / n
+    var = sum([(e[0] - mean_t) ** 2 for e in entries])
+    if var == 0:
+        return None
+    cov = sum([(e[0] - mean_t) * (e[1] - mean_c) for e in entries])
+    return cov / var * 60.0
+
+def evalTempTrend(readings, history, window, rateWarn, rateCrit, result):
+    """record readings in history and alert on how fast each zone is heating up"""
+    now = time.time()
+    test_ok = 1
+    for r in readings:
+        key = r.sensor + "_" + r.zone
+        history.append(key, now, r.temp)
+        entries = history.window(key, now - window * 60)
+        # a couple of readings close together (e.g. two services sharing the
+        # history file) say nothing about the trend
+        if len(entries) < TREND_MIN_SAMPLES or entries[0][0] - entries[-1][0] < window * 60 / 2.0:
             continue
-        if line[:9] == "DIMM Conf" or line[:9] == "---------":
+        rate = tempRate(entries)
+        if rate is None:
             continue
+        label = "temp" + r.sensor + "_" + r.zone
+        result.perf(label + "_rate", "%.2f" % rate, "", rateWarn, rateCrit)
+        trend = ""
+        if r.threshold is not None and rate > 0:
+            # minutes until the zone reaches its threshold at the current rate
+            ttt = max(r.threshold - r.temp, 0) / rate
+            result.perf(label + "_ttt", "%.1f" % ttt)
+            trend = ", " + r.threshold.__str__() + "C in " + str(int(ttt)) + "m"
+        if rate >= rateCrit:
+            result.message = result.message + " " + r.zone + " rising " + ("%.1f" % rate) + "C/min" + trend + " "
+            result.critical = 1
+            test_ok = 0
+        elif rate >= rateWarn:
+            result.message = result.message + " " + r.zone + " rising " + ("%.1f" % rate) + "C/min" + trend + " "
+            result.warning = 1
+            test_ok = 0
+    return test_ok
 
-        fields = line.split(":")
-        if fields[0].strip()[:6] == "Module":
-            # start a new module
-            if dimm_num != "":
-                # process last module
-                if status != "Ok" and status != "N/A":
-                    print "dimm_num=" + dimm_num + " status= " + status + " present=" + present
-                    message = message + "DIMM" + dimm_num + " Status: " + status + ". "
-                    is_CRITICAL = 1
-                    test_ok = 0
-            dimm_num = fields[0].strip()
-            num_dimms = num_dimms + 1
-        if fields[0].strip() == "Present":
-            present = fields[1].strip()
-        if fields[0].strip() == "Status":
-            status = fields[1].strip()
-
-    # process the last module
-    if status != "Ok" and status != "N/A":
-        print "dimm_num=" + dimm_num + " status= " + status + " present=" + present
-        message = message + "DIMM" + dimm_num + " Status: " + status + ". "
-        is_CRITICAL = 1
-        test_ok = 0
+class IMLEvent(object):
+    """one entry of SHOW IML"""
+    __slots__ = ('event', 'added', 'severity', 'text', 'digest')
 
+    def __init__(self, event, added, severity, text, digest):
+        self.event = event # int event number
+        self.added = added
+        self.severity = severity # CRITICAL, CAUTION, REPAIRED, INFORMATIONAL
+        self.text = text
+        self.digest = digest # hash of the entry's header, to recognise it next run
+
+def parseIML(output, after=None):
+    """
+    Parse SHOW IML output newest-first, stopping at the cursor entry after
+    (event number, digest) so only entries added since it are examined.
+    The digest covers just the entry's header (event number and time
+    added), since marking an entry repaired rewrites its severity. If the
+    cursor entry is gone or was added at another time, the log was cleared
+    and every entry is returned. Events come back oldest first.
+    """
+    events = []
+    body = []
+    for line in reversed(output.split("\n")):
+        line = line.strip()
+        if line[:6] != "Event:":
+            # skip over blank lines or command echo
+            if line != "" and line != "SHOW IML":
+                body.append(line)
+            continue
+        # header: "Event: 25 Added: 09/19/2012 10:37"
+        fields = line.split()
+        body.reverse()
+        text = " ".join(body)
+        body = []
+        digest = hashlib.md5(" ".join(fields)).hexdigest()
+        if after is not None and int(fields[1]) <= after[0]:
+            if int(fields[1]) == after[0] and digest == after[1]:
+                break
+            # cursor no longer matches; the log was cleared, so take it all
+            after = None
+        severity = ""
+        if text.find(":") > 0:
+            severity, text = text.split(":", 1)
+        events.append(IMLEvent(int(fields[1]), " ".join(fields[3:]), severity.strip(), text.strip(), digest))
+    events.reverse()
+    return events
+
+class IMLCursor:
+    """the last IML entry already reported, kept in a small state file"""
+    def __init__(self, path=IML_CURSOR):
+        self.path = path
+
+    def load(self):
+        """return (event number, digest) of the last entry seen, or None"""
+        try:
+            f = open(self.path)
+            try:
+                event, digest = f.read().split()
+            finally:
+                f.close()
+            return (int(event), digest)
+        except (IOError, ValueError):
+            return None
+
+    def save(self, event):
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path), 0700)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path))
+            try:
+                os.write(fd, "%d %s\n" % (event.event, event.digest))
+            finally:
+                os.close(fd)
+            os.rename(tmp, self.path)
+        except (IOError, OSError), e:
+            raise HpasmError("Unable to save IML cursor " + self.path + ": " + str(e))
+
+def evalIML(events, ignoreRedundant, result):
+    test_ok = 1
+    for e in events:
+        if e.severity == "CRITICAL":
+            result.message = result.message + "IML " + str(e.event) + " CRITICAL: " + e.text + " "
+            result.critical = 1
+            test_ok = 0
+        elif e.severity == "CAUTION":
+            result.message = result.message + "IML " + str(e.event) + " CAUTION: " + e.text + " "
+            result.warning = 1
+            test_ok = 0
+    result.perf("iml_new", len(events))
     if test_ok == 1:
-        message = message + " ALL (" + str(num_dimms) + ") DIMMs Ok."
+        result.message = result.message + " " + str(len(events)) + " new IML events."
     return test_ok
 
+# check type => (hpasmcli command, parser, evaluator)
+CHECKS = {
+    'fan':  ("SHOW FANS", parseFans, evalFans),
+    'ps':   ("SHOW POWERSUPPLY", parsePower, evalPower),
+    'temp': ("SHOW TEMP", parseTemp, evalTemp),
+    'dimm': ("SHOW DIMM", parseDIMM, evalDIMM),
+    'proc': ("SHOW SERVER", parseProc, evalProc),
+    'iml':  ("SHOW IML", parseIML, evalIML),
+}
+ALL_TYPES = ['fan', 'ps', 'temp', 'dimm', 'proc']
+
+BACKENDS = {
+    'pexpect': HpasmSession,
+    'batch': HpasmBatch,
+    'hwmon': HwmonSession,
+}
+
+def syntheticOutput(t, rows):
+    """
+    Generate hpasmcli-style output for check type t with the given number
+    of rows, including the "-" temperature and threshold rows that real
+    systems print for absent or unmonitored sensors.
+    """
+    lines = []
+    if t == 'fan':
+        lines.append("Fan  Location        Present Speed  of max  Redundant  Partner  Hot-pluggable")
+        lines.append("---  --------        ------- -----  ------  ---------  -------  -------------")
+        for i in range(1, rows + 1):
+            lines.append("#%-3d %-15s Yes     NORMAL  %d%%     Yes        %d        Yes" % (i, "ZONE_%d" % (i % 8), 20 + i % 60, i + 1))
+    elif t == 'ps':
+        for i in range(1, rows + 1):
+            lines.extend(["Power supply #%d" % i, "\tPresent  : Yes", "\tRedundant: Yes",
+                          "\tCondition: Ok", "\tHotplug  : Supported", "\tPower    : 110 Watts"])
+    elif t == 'temp':
+        lines.append("Sensor   Location              Temp       Threshold")
+        lines.append("------   --------              ----       ---------")
+        for i in range(1, rows + 1):
+            temp = 20 + i % 40
+            if i % 11 == 0:
+                cur = "-"
+            else:
+                cur = "%dC/%dF" % (temp, temp * 9 / 5 + 32)
+            if i % 7 == 0:
+                threshold = "-"
+            else:
+                threshold = "%dC/%dF" % (temp + 30, (temp + 30) * 9 / 5 + 32)
+            lines.append("%-8s %-21s %-10s %s" % ("#%d" % i, "ZONE_%d" % (i % 16), cur, threshold))
+    elif t == 'dimm':
+        lines.extend(["DIMM Configuration", "------------------"])
+        for i in range(1, rows + 1):
+            lines.extend(["Processor #:                  %d" % (i % 4 + 1), "Module #:                     %d" % i,
+                          "Present:                      Yes", "Size:                         8192 MB",
+                          "Status:                       Ok", ""])
+    elif t == 'proc':
+        lines.extend(["System        : ProLiant DL380 Gen9", "Serial No.    : CZ00000000", ""])
+        for i in range(rows):
+            lines.extend(["Processor: %d" % i, "\tName         : Intel Xeon", "\tCore         : 8",
+                          "\tStatus       : Ok", ""])
+        lines.append("Processor total  : %d" % rows)
+    return "\n".join(lines) + "\n"
+
+def benchmark(rows, iterations=5):
+    """time parsing and evaluation of synthetic output for every check type"""
+    print "%-6s %8s %12s %12s" % ("type", "rows", "parse (ms)", "eval (ms)")
+    for t in ALL_TYPES:
+        command, parser, evaluator = CHECKS[t]
+        output = syntheticOutput(t, rows)
+        best_parse = None
+        best_eval = None
+        for i in range(iterations):
+            start = timeit.default_timer()
+            records = parser(output)
+            parsed = timeit.default_timer()
+            evaluator(records, 0, CheckResult())
+            done = timeit.default_timer()
+            if best_parse is None or parsed - start < best_parse:
+                best_parse = parsed - start
+            if best_eval is None or done - parsed < best_eval:
+                best_eval = done - parsed
+        print "%-6s %8d %12.3f %12.3f" % (t, rows, best_parse * 1000, best_eval * 1000)
+
+def runChecks(session, types, ignoreRedundant, trend=None, imlCursor=IML_CURSOR):
+    """
+    Run the given check types over session and return their CheckResult.
+    trend, if given, is (history file, window, warn rate, crit rate).
+    """
+    result = CheckResult()
+    session.prefetch([CHECKS[t][0] for t in types])
+    for t in types:
+        command, parser, evaluator = CHECKS[t]
+        output = session.run(command)
+        started = timings.start()
+        try:
+            if t == 'iml':
+                cursor = IMLCursor(imlCursor)
+                last = cursor.load()
+                records = parser(output, last)
+            else:
+                records = parser(output)
+        except (IndexError, ValueError):
+            raise HpasmError("Unable to parse hpasmcli output for " + command)
+        if t == 'iml':
+            if len(records) > 0:
+                cursor.save(records[-1])
+            if last is None:
+                # first run: start from the end of the log, don't alert on its history
+                records = []
+        if t == 'temp' and trend is not None:
+            historyFile, trendWindow, trendWarn, trendCrit = trend
+            history = TempHistory(historyFile)
+            history.open()
+            try:
+                evaluator(records, ignoreRedundant, result, (history, trendWindow, trendWarn, trendCrit))
+            finally:
+                history.close()
+        else:
+            evaluator(records, ignoreRedundant, result)
+        timings.record("parse_" + t, started)
+    return result
+
+def submitResult(cmdFile, host, service, code, output):
+    """write a passive service check result to the Nagios/Icinga external command file"""
+    line = "[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n" % (time.time(), host, service, code, output)
+    try:
+        f = open(cmdFile, "a")
+        try:
+            f.write(line)
+        finally:
+            f.close()
+    except IOError, e:
+        sys.stderr.write("Unable to write to command file " + cmdFile + ": " + str(e) + "\n")
+
+def runDaemon(session, types, ignoreRedundant, trend, imlCursor, host, cmdFile, intervals, services,
+              timing=0, traceFile=None, backend=None):
+    """
+    Poll each check type on its own interval over one long-lived session,
+    submitting every result as a passive check. Runs until killed.
+    """
+    due = {}
+    for t in types:
+        due[t] = 0
+    while True:
+        for t in types:
+            now = time.time()
+            if due[t] > now:
+                continue
+            due[t] = now + intervals[t]
+            timings.reset()
+            result = CheckResult()
+            try:
+                result = runChecks(session, [t], ignoreRedundant, trend, imlCursor)
+            except HpasmError, e:
+                result.unknown = 1
+                result.message = str(e)
+                # start hpasmcli afresh on the next poll
+                session.close()
+            if timing == 1:
+                timings.perf(result)
+            if traceFile is not None:
+                timings.trace(traceFile, backend, [t])
+            submitResult(cmdFile, host, services[t], result.code(), result.output())
+        time.sleep(max(min(due.values()) - time.time(), 0))
+
 def main(argv):
     ignoreRedundant = 0
+    backend = 'pexpect'
+    replay = None
+    trend = 0
+    trendWarn = TREND_WARN
+    trendCrit = TREND_CRIT
+    trendWindow = TREND_WINDOW
+    historyFile = HISTORY_FILE
+    imlCursor = IML_CURSOR
+    timing = 0
+    traceFile = None
+    daemon = 0
+    host = socket.gethostname()
+    cmdFile = COMMAND_FILE
+    intervals = DAEMON_INTERVAL.copy()
+    services = {}
+    useCache = 0
+    cacheDir = CACHE_DIR
+    cacheTTL = CACHE_TTL.copy()
     try:
-        opts, args = getopt.getopt(argv, "h", ["type=", "help", "ignore-redundant"])
+        opts, args = getopt.getopt(argv, "h", ["type=", "help", "ignore-redundant", "cache",
+                                               "cache-dir=", "cache-ttl=", "backend=",
+                                               "replay=", "benchmark=", "trend", "trend-warn=",
+                                               "trend-crit=", "trend-window=", "history-file=",
+                                               "daemon", "host=", "command-file=", "interval=",
+                                               "service=", "iml-cursor=", "timing",
+                                               "trace-file="])
     except getopt.GetoptError:
         print "UNKNOWN: Invalid Argument."
         usage()
@@ -395,40 +1283,134 @@ def main(argv):
             type = arg
         elif opt in ("--ignore-redundant"):
             ignoreRedundant = 1
+        elif opt == "--backend":
+            if arg not in BACKENDS:
+                print "UNKNOWN: Invalid backend '" + arg + "'."
+                usage()
+                sys.exit(3)
+            backend = arg
+        elif opt == "--replay":
+            replay = arg
+        elif opt == "--benchmark":
+            try:
+                rows = int(arg)
+            except ValueError:
+                print "UNKNOWN: Invalid number of benchmark rows '" + arg + "'."
+                sys.exit(3)
+            benchmark(rows)
+            sys.exit(0)
+        elif opt == "--trend":
+            trend = 1
+        elif opt in ("--trend-warn", "--trend-crit", "--trend-window"):
+            trend = 1
+            try:
+                value = float(arg)
+            except ValueError:
+                print "UNKNOWN: Invalid value '" + arg + "' for " + opt + "."
+                sys.exit(3)
+            if opt == "--trend-warn":
+                trendWarn = value
+            elif opt == "--trend-crit":
+                trendCrit = value
+            else:
+                trendWindow = value
+        elif opt == "--history-file":
+            trend = 1
+            historyFile = arg
+        elif opt == "--timing":
+            timing = 1
+        elif opt == "--trace-file":
+            traceFile = arg
+        elif opt == "--iml-cursor":
+            imlCursor = arg
+        elif opt == "--daemon":
+            daemon = 1
+        elif opt == "--host":
+            host = arg
+        elif opt == "--command-file":
+            cmdFile = arg
+        elif opt == "--interval":
+            try:
+                t, interval = arg.split(":")
+                if t not in CHECKS:
+                    raise ValueError
+                intervals[t] = int(interval)
+            except ValueError:
+                print "UNKNOWN: Invalid interval '" + arg + "'."
+                usage()
+                sys.exit(3)
+        elif opt == "--service":
+            t, sep, description = arg.partition(":")
+            if t not in CHECKS or description == "":
+                print "UNKNOWN: Invalid service '" + arg + "'."
+                usage()
+                sys.exit(3)
+            services[t] = description
+        elif opt == "--cache":
+            useCache = 1
+        elif opt == "--cache-dir":
+            useCache = 1
+            cacheDir = arg
+        elif opt == "--cache-ttl":
+            useCache = 1
+            try:
+                t, ttl = arg.split(":")
+                cacheTTL[CHECKS[t][0]] = int(ttl)
+            except (ValueError, KeyError):
+                print "UNKNOWN: Invalid cache TTL '" + arg + "'."
+                usage()
+                sys.exit(3)
     if not 'type' in locals() or type == '':
         print "UNKNOWN: INPUT ERROR: Type cannot be empty!"
         usage()
         sys.exit(3)
 
-    if type == 'fan':
-         doFans(ignoreRedundant)
-    elif type == 'ps':
-         doPower(ignoreRedundant)
-    elif type == 'temp':
-         doTemp(ignoreRedundant)
-    elif type == 'dimm':
-        doDIMM(ignoreRedundant)
-    elif type == 'proc':
-        doProc(ignoreRedundant)
-    elif type == 'all':
-         doFans(ignoreRedundant)
-         doPower(ignoreRedundant)
-         doTemp(ignoreRedundant)
-         doDIMM(ignoreRedundant)
-         doProc(ignoreRedundant)
+    if type == 'all':
+        types = ALL_TYPES
+    elif type in CHECKS:
+        types = [type]
     else:
         print "UNKNOWN: Invalid type option."
         sys.exit(3)
 
-    if is_CRITICAL != 0:
-        print "CRITICAL: "+message
-        sys.exit(2)
-    if is_WARNING != 0:
-        print "WARNING: "+message
-        sys.exit(1)
-    
-    print "OK: "+message
-    sys.exit(0)
+    # one hpasmcli session for every subsystem we were asked about
+    if replay is not None:
+        backend = 'replay'
+        session = ReplaySession(replay)
+    else:
+        session = BACKENDS[backend]()
+    if useCache == 1:
+        session = CachedSession(session, cacheDir, cacheTTL)
+    trendSettings = None
+    if trend == 1:
+        trendSettings = (historyFile, trendWindow, trendWarn, trendCrit)
+
+    if daemon == 1:
+        for t in types:
+            services.setdefault(t, t)
+        # make sure hpasmcli is shut down cleanly when we're stopped
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            runDaemon(session, types, ignoreRedundant, trendSettings, imlCursor, host, cmdFile, intervals,
+                      services, timing, traceFile, backend)
+        finally:
+            session.close()
+
+    result = CheckResult()
+    try:
+        result = runChecks(session, types, ignoreRedundant, trendSettings, imlCursor)
+    except HpasmError, e:
+        result.unknown = 1
+        result.message = str(e)
+    finally:
+        session.close()
+
+    if timing == 1:
+        timings.perf(result)
+    if traceFile is not None:
+        timings.trace(traceFile, backend, types)
+    print result.output()
+    sys.exit(result.code())
 
 if __name__ == "__main__":
     main(sys.argv[1:])
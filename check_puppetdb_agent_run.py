@@ -21,24 +21,514 @@ via PuppetDB report storage (using pypuppetdb).
 
 import sys
 import os
+import time
+import math
+import re
+import json
+import heapq
+import codecs
+import fcntl
+import hashlib
+import sqlite3
+import threading
 import requests
 from datetime import datetime
 import pytz
 import logging
 import argparse
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import nagiosplugin
-from pypuppetdb import connect
+from pypuppetdb.api.v3 import API
+from pypuppetdb.types import Report
+from pypuppetdb.utils import json_to_datetime
 
 _log = logging.getLogger('nagiosplugin')
 utc = pytz.utc
 
+# PuppetDB sorts a node's reports by this (newest first) and returns only
+# the first, so the check fetches one report however long the history is
+LATEST_REPORT_ORDER = json.dumps([{'field': 'start-time', 'order': 'desc'}])
+
+# fleet mode asks for the latest reports of this many nodes per query...
+FLEET_CHUNK = 50
+# ...getting this many reports per node, newest first; the nodes that
+# ran too long ago to be among them (crowded out by nodes that report
+# more often) are asked for again, together, until all are found
+FLEET_REPORTS_PER_NODE = 2
+
+# a request also goes to the next PuppetDB replica when the last one
+# asked has taken longer than this percentile of its earlier replies...
+HEDGE_PERCENTILE = 95
+# ...once it has this many to go by; until then, after HEDGE_DELAY seconds
+HEDGE_MIN_SAMPLES = 10
+HEDGE_DELAY = 1.0
+# --cache keeps this many reply times per replica for later runs
+HEDGE_HISTORY = 200
+# the error of a request get() returned without waiting for
+ABANDONED = 'abandoned'
+# --cache remembers what the PuppetDB serves (see HedgedAPI.remember)
+# for this many seconds, so a server upgrade is noticed within a day
+PROBE_TTL = 86400
+
+def parse_endpoint(value):
+    """'host' or 'host:port' as a (host, port) tuple; PuppetDB's port 8080 by default"""
+    if value.count(':') == 1:
+        host, port = value.split(':')
+        return (host, int(port))
+    return (value, 8080)
+
+def percentile(values, pct):
+    """the pct'th percentile of values, by nearest rank"""
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(pct / 100.0 * len(ordered))) - 1)]
+
+def describe_error(e):
+    """a short description of a failed request"""
+    if isinstance(e, requests.exceptions.HTTPError):
+        return str(e)
+    return e.__class__.__name__
+
+class HedgedAPI(API):
+    """
+    pypuppetdb v3 API over one or more PuppetDB replicas. A request goes to
+    the replica that has been answering fastest; if that has not replied
+    within the hedge percentile of its reply times, the same request also
+    goes to the next replica, and so on, and the first reply is used.
+    Server errors and failed connections move on to the next replica at
+    once. A replica that failed or was hedged past goes last for the rest
+    of the run. Each replica has its own requests Session, so its
+    connection is reused from one request to the next.
+    """
+    def __init__(self, endpoints, hedge_percentile=HEDGE_PERCENTILE, hedge_delay=HEDGE_DELAY, **kwargs):
+        super(HedgedAPI, self).__init__(host=endpoints[0][0], port=endpoints[0][1], **kwargs)
+        self.hedge_percentile = hedge_percentile
+        self.hedge_delay = hedge_delay
+        self.replicas = []
+        for host, port in endpoints:
+            session = requests.Session()
+            session.verify = self.ssl_verify
+            session.cert = (self.ssl_cert, self.ssl_key)
+            session.headers.update({'accept': 'application/json', 'accept-charset': 'utf-8'})
+            self.replicas.append(('%s:%d' % (host, port), session))
+        # reply times of earlier runs, by replica (see CachedAPI)
+        self.reply_times = dict((replica, []) for replica, session in self.replicas)
+        # (replica, seconds, error or None) of each request this run,
+        # appended by the request threads as they finish, or by get()
+        # with error ABANDONED for those still running when it returns
+        self.samples = []
+        self.saved = 0
+        # replicas that failed or were hedged past this run
+        self.demoted = set()
+        self.sent = dict((replica, 0) for replica, session in self.replicas)
+        self.used = dict((replica, 0) for replica, session in self.replicas)
+        # what remember() kept this run, by key
+        self.probes = {}
+
+    def path(self, endpoint, path=None):
+        """the URL path of a pypuppetdb endpoint, without the replica's base URL"""
+        return self._url(endpoint, path)[len(self.base_url):]
+
+    def seconds(self, sample_seconds, error):
+        """
+        a sample as the hedge counts it: a request abandoned unanswered took
+        at least as long as it ran, and a failed one at least hedge_delay
+        """
+        if error is None or error == ABANDONED:
+            return sample_seconds
+        return max(sample_seconds, self.hedge_delay)
+
+    def times(self, replica):
+        """replica's reply times from earlier runs and this one"""
+        return self.reply_times[replica] + [self.seconds(s, e) for r, s, e in self.samples if r == replica]
+
+    def delay(self, replica):
+        """seconds to wait for a reply from replica before asking the next one too"""
+        times = self.times(replica)
+        if len(times) < HEDGE_MIN_SAMPLES:
+            return self.hedge_delay
+        return percentile(times, self.hedge_percentile)
+
+    def rank(self, replica):
+        """sort key for the order replicas are asked in, fastest first"""
+        times = self.times(replica)
+        # the median orders replicas with too few samples for a percentile
+        return (replica in self.demoted, self.delay(replica), median(times) if times else 0)
+
+    def record(self, replica, outstanding, lock, error):
+        """keep the sample of replica's request, unless get() already gave it up as abandoned"""
+        with lock:
+            start = outstanding.pop(replica, None)
+            if start is not None:
+                self.samples.append((replica, time.time() - start, error))
+
+    def fetch(self, replica, session, path, params, stream, replies, abandoned, outstanding, lock):
+        """GET path from one replica, in its own thread, putting (replica, response or error) on replies"""
+        try:
+            r = session.get('%s://%s%s' % (self.protocol, replica, path), params=params,
+                            stream=stream, timeout=self.timeout)
+            if r.status_code >= 500:
+                r.raise_for_status()
+        except Exception as e:
+            # get() waits for every request it sent to report back
+            self.record(replica, outstanding, lock, describe_error(e))
+            replies.put((replica, e))
+            return
+        self.record(replica, outstanding, lock, None)
+        if abandoned.is_set():
+            r.close()
+        replies.put((replica, r))
+
+    def get(self, path, params=None, stream=False):
+        """
+        GET path from the replicas, hedged, and return the first response
+        that is not a server error. Raises CheckError if no replica replies.
+        """
+        order = sorted(self.replicas, key=lambda replica: self.rank(replica[0]))
+        replies = queue.Queue()
+        abandoned = threading.Event()
+        # start time of each request still running, by replica
+        outstanding = {}
+        lock = threading.Lock()
+        pending = 0
+        errors = []
+        launch = True
+        try:
+            while True:
+                if launch and order:
+                    last, session = order.pop(0)
+                    _log.debug("GET %s from %s" % (path, last))
+                    outstanding[last] = time.time()
+                    t = threading.Thread(target=self.fetch,
+                                         args=(last, session, path, params, stream, replies, abandoned,
+                                               outstanding, lock))
+                    t.daemon = True
+                    t.start()
+                    self.sent[last] += 1
+                    pending += 1
+                    wait = self.delay(last)
+                    launch = False
+                if pending == 0:
+                    raise nagiosplugin.CheckError('no reply from PuppetDB: %s' % '; '.join(errors))
+                try:
+                    # a timeout keeps the wait interruptible by the check's -t alarm
+                    replica, r = replies.get(True, wait if order else self.timeout)
+                except queue.Empty:
+                    if order:
+                        _log.info("no reply after %.3fs; also asking the next replica" % wait)
+                        self.demoted.add(last)
+                        launch = True
+                    continue
+                pending -= 1
+                if isinstance(r, Exception):
+                    _log.info("%s failed: %s" % (replica, describe_error(r)))
+                    errors.append('%s %s' % (replica, describe_error(r)))
+                    self.demoted.add(replica)
+                    launch = True
+                    continue
+                self.used[replica] += 1
+                return r
+        finally:
+            abandoned.set()
+            with lock:
+                # the replicas still working on it took at least this long
+                for replica, start in outstanding.items():
+                    self.samples.append((replica, time.time() - start, ABANDONED))
+                outstanding.clear()
+            samples = self.samples[self.saved:]
+            self.saved += len(samples)
+            self.save_reply_times(samples)
+
+    def save_reply_times(self, samples):
+        """keep this run's reply times for later runs; only CachedAPI has somewhere to"""
+        pass
+
+    def recall(self, key):
+        """what remember() last kept for key, or None"""
+        return self.probes.get(key)
+
+    def remember(self, key, value):
+        """
+        keep the outcome of probing the PuppetDB for a feature, so it is
+        probed once per run (once per PROBE_TTL with CachedAPI)
+        """
+        self.probes[key] = value
+
+    def _query(self, endpoint, path=None, query=None, order_by=None, limit=None, offset=None,
+               include_total=False, summarize_by=None, count_by=None, count_filter=None):
+        """pypuppetdb's query method, sent to the replicas through get()"""
+        params = {'query': query, 'order-by': order_by, 'limit': limit, 'offset': offset,
+                  'summarize-by': summarize_by, 'count-by': count_by, 'count-filter': count_filter}
+        if include_total:
+            params['include-total'] = 'true'
+        r = self.get(self.path(endpoint, path), dict((k, v) for k, v in params.items() if v is not None))
+        r.raise_for_status()
+        self.last_total = r.headers.get('X-Records')
+        return r.json()
+
+    def latency_lines(self):
+        """long output: how each replica replied to this run's requests"""
+        lines = []
+        for replica, session in self.replicas:
+            times = [s for r, s, e in self.samples if r == replica and e is None]
+            failed = len([e for r, s, e in self.samples if r == replica and e not in (None, ABANDONED)])
+            unanswered = len([e for r, s, e in self.samples if r == replica and e == ABANDONED])
+            if len(times) > 0:
+                replied = "%d replies in median %.3fs, max %.3fs" % (len(times), median(times), max(times))
+            else:
+                replied = "no replies"
+            lines.append("PuppetDB %s: %d sent, %s, %d used, %d failed, %d abandoned; hedging after %.3fs" % (
+                replica, self.sent[replica], replied, self.used[replica], failed, unanswered, self.delay(replica)))
+        return lines
+
+class CachedAPI(HedgedAPI):
+    """
+    pypuppetdb v3 API whose query responses are kept for ttl seconds in a
+    SQLite file shared by every check run on this host. A process that
+    misses the cache takes a lock on that query (one byte of a lock file,
+    at an offset hashed from the query), so checks started at the same
+    moment wait for one PuppetDB fetch instead of each making their own.
+    Errors are never cached. The replicas' reply times are kept there too,
+    so the hedge percentile is taken from more than one run.
+    """
+    def __init__(self, cache_file, ttl, *args, **kwargs):
+        super(CachedAPI, self).__init__(*args, **kwargs)
+        self.ttl = ttl
+        self.db = sqlite3.connect(cache_file, timeout=10)
+        self.db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, fetched REAL, body TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS reply_times (replica TEXT, measured REAL, seconds REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS probes (key TEXT PRIMARY KEY, probed REAL, value TEXT)")
+        self.db.commit()
+        for replica, seconds in self.db.execute("SELECT replica, seconds FROM reply_times ORDER BY measured"):
+            if replica in self.reply_times:
+                self.reply_times[replica].append(seconds)
+        self.lock_fd = os.open(cache_file + '.lock', os.O_RDWR | os.O_CREAT, 0o666)
+
+    def cached(self, key):
+        """return a fresh cached response as a one-element list, else None"""
+        row = self.db.execute("SELECT fetched, body FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None or time.time() - row[0] >= self.ttl:
+            return None
+        return [json.loads(row[1])]
+
+    def save_reply_times(self, samples):
+        now = time.time()
+        self.db.executemany("INSERT INTO reply_times (replica, measured, seconds) VALUES (?, ?, ?)",
+                            [(r, now, self.seconds(s, e)) for r, s, e in samples])
+        for replica in set([r for r, s, e in samples]):
+            self.db.execute("DELETE FROM reply_times WHERE replica = ? AND rowid NOT IN "
+                            "(SELECT rowid FROM reply_times WHERE replica = ? ORDER BY measured DESC LIMIT ?)",
+                            (replica, replica, HEDGE_HISTORY))
+        self.db.commit()
+
+    def recall(self, key):
+        value = super(CachedAPI, self).recall(key)
+        if value is not None:
+            return value
+        row = self.db.execute("SELECT value FROM probes WHERE key = ? AND probed >= ?",
+                              (json.dumps([self.host, self.port, key]), time.time() - PROBE_TTL)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def remember(self, key, value):
+        super(CachedAPI, self).remember(key, value)
+        self.db.execute("INSERT OR REPLACE INTO probes (key, probed, value) VALUES (?, ?, ?)",
+                        (json.dumps([self.host, self.port, key]), time.time(), json.dumps(value)))
+        self.db.commit()
+
+    def _query(self, endpoint, *args, **kwargs):
+        key = json.dumps([self.host, self.port, endpoint, args, sorted(kwargs.items())])
+        hit = self.cached(key)
+        if hit is not None:
+            _log.debug("cache hit for %s" % key)
+            return hit[0]
+        offset = int(hashlib.md5(key.encode('utf-8')).hexdigest()[:7], 16)
+        fcntl.lockf(self.lock_fd, fcntl.LOCK_EX, 1, offset)
+        try:
+            # another check may have fetched it while we waited for the lock
+            hit = self.cached(key)
+            if hit is not None:
+                _log.debug("cache filled while waiting for %s" % key)
+                return hit[0]
+            _log.debug("cache miss for %s" % key)
+            body = super(CachedAPI, self)._query(endpoint, *args, **kwargs)
+            now = time.time()
+            self.db.execute("INSERT OR REPLACE INTO responses (key, fetched, body) VALUES (?, ?, ?)",
+                            (key, now, json.dumps(body)))
+            self.db.execute("DELETE FROM responses WHERE fetched < ?", (now - self.ttl,))
+            self.db.commit()
+            return body
+        finally:
+            fcntl.lockf(self.lock_fd, fcntl.LOCK_UN, 1, offset)
+
+def puppetdb_api(puppetdb, cache_file=None, cache_ttl=60, hedge_percentile=HEDGE_PERCENTILE,
+                 hedge_delay=HEDGE_DELAY):
+    """
+    a pypuppetdb API for the given comma-separated PuppetDB host[:port]s,
+    cached in cache_file if given
+    """
+    endpoints = [parse_endpoint(p) for p in puppetdb.split(',')]
+    if cache_file is None:
+        return HedgedAPI(endpoints, hedge_percentile, hedge_delay)
+    return CachedAPI(cache_file, cache_ttl, endpoints, hedge_percentile, hedge_delay)
+
+# --regression needs at least this many earlier runs for a baseline
+REGRESSION_MIN_RUNS = 5
+# scale of the median absolute deviation that matches a normal
+# distribution's standard deviation
+MAD_SCALE = 1.4826
+# the spread used for the outlier score is at least this fraction of the
+# median, so nodes whose runs never vary do not alert on every second
+REGRESSION_MIN_SPREAD = 0.05
+
+def total_seconds(delta):
+    """a timedelta in seconds; timedelta.total_seconds() is new in py27"""
+    try:
+        return delta.total_seconds()
+    except AttributeError:
+        return (delta.microseconds + (delta.seconds + delta.days * 24 * 3600) * 10**6) / 10**6
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+# bytes read from the network at a time when streaming a listing
+STREAM_CHUNK = 16384
+
+def iter_json_array(chunks):
+    """
+    Yield the elements of a JSON array of objects arriving as an iterable
+    of text chunks, each as soon as it is complete, so that only one
+    element (and one chunk) is held in memory at a time.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    started = False
+    for chunk in chunks:
+        buf += chunk
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buf):
+                break
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError('expected a JSON array, got %r' % buf[pos:pos + 20])
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            try:
+                # elements are objects, so one can only decode once its
+                # closing brace has arrived
+                obj, pos_after = decoder.raw_decode(buf, pos)
+            except ValueError:
+                break
+            yield obj
+            pos = pos_after
+        buf = buf[pos:]
+    raise ValueError('JSON array ended early')
+
+class ReportStub(object):
+    """The fields of a report the check uses; all a streamed listing keeps of each."""
+    __slots__ = ('node', 'hash_', 'start', 'end', 'status')
+
+    def __init__(self, r):
+        self.node = r['certname']
+        self.hash_ = r['hash']
+        self.start = json_to_datetime(r['start-time'])
+        self.end = json_to_datetime(r['end-time'])
+        # only PuppetDB 3.0 and later (API v4) record the run's status
+        self.status = r.get('status')
+
+def stream_query(pdb, endpoint, query, order_by=None, limit=None):
+    """
+    Yield each entry of a PuppetDB listing as a dict, parsing the
+    response as it arrives instead of loading the whole listing first.
+    Goes to pdb's replicas like any other query, but bypasses any cache.
+    """
+    params = {'query': query}
+    if order_by is not None:
+        params['order-by'] = order_by
+    if limit is not None:
+        params['limit'] = limit
+    r = pdb.get(pdb.path(endpoint), params, stream=True)
+    try:
+        r.raise_for_status()
+        utf8 = codecs.getincrementaldecoder('utf-8')()
+        chunks = (utf8.decode(chunk) for chunk in r.iter_content(STREAM_CHUNK))
+        for entry in iter_json_array(chunks):
+            yield entry
+    finally:
+        r.close()
+
+def stream_reports(pdb, query, order_by=None, limit=None):
+    """Yield a ReportStub for each report matching query, streamed."""
+    for report in stream_query(pdb, 'reports', query, order_by, limit):
+        yield ReportStub(report)
+
+# where PuppetDB serves a report's metrics, by report hash, newest API
+# first; the v3 API that pypuppetdb 0.1 speaks does not store them
+REPORT_METRICS_PATHS = ['/pdb/query/v4/reports/%s/metrics', '/v4/reports/%s/metrics']
+
+# a report's events in the order the agent applied them
+EVENT_ORDER = json.dumps([{'field': 'timestamp', 'order': 'asc'}])
+
+def perf_label(name):
+    """a resource or metric name made safe to use as a perfdata label"""
+    return re.sub(r"['=|]", '_', name)
+
+def report_from_json(r):
+    """build a pypuppetdb Report from one entry of a reports query"""
+    return Report(
+        r['certname'],
+        r['hash'],
+        r['start-time'],
+        r['end-time'],
+        r['receive-time'],
+        r['configuration-version'],
+        r['report-format'],
+        r['puppet-version'],
+        r['transaction-uuid'])
+
+def submit_result(command_file, host, service, code, output):
+    """
+    write a passive service check result to the Nagios/Icinga external
+    command file; one write per line, so lines are never interleaved
+    with other writers to the pipe
+    """
+    line = "[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n" % (time.time(), host, service, code, output)
+    try:
+        fd = os.open(command_file, os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, line.encode('utf-8'))
+        finally:
+            os.close(fd)
+    except OSError as e:
+        raise nagiosplugin.CheckError('Unable to write to command file %s: %s' % (command_file, e))
+
 class PuppetdbAgentRun(nagiosplugin.Resource):
     """Uses PyPuppetDB to check the last run time of a puppet node, via PuppetDB reports."""
-    def __init__(self, hostname, puppetdb):
+    def __init__(self, hostname, puppetdb, pdb=None, regression=None, slowest=None):
         self.hostname = hostname
         self.puppetdb_host = puppetdb
-        self.pdb = connect(host=puppetdb)
+        if pdb is None:
+            pdb = puppetdb_api(puppetdb)
+        self.pdb = pdb
+        self.regression = regression
+        self.history = []
+        self.slowest = slowest
+        self.slowest_types = []
+        self.slowest_resources = []
 
     def get_node_by_certname(self, certname):
         """ gets a pypuppetdb node object given a certname"""
@@ -58,23 +548,22 @@ class PuppetdbAgentRun(nagiosplugin.Resource):
 
     def get_node_latest_report(self, node):
         """
-        For a puppetdb Node object, return the latest report.
+        For a puppetdb Node object, return the latest report (by start time),
+        letting PuppetDB do the sorting and return just that one.
         """
-        reports = node.reports()
-
-        latest_report_start = None
-        latest_report = None
-
-        for r in reports:
-            if latest_report_start is None:
-                latest_report_start = datetime(1970,1,1,tzinfo=utc)
-            if r.start > latest_report_start:
-                latest_report_start = r.start
-                latest_report = r
+        if node.report_timestamp is None:
+            _log.info("Node has no report timestamp; no reports stored.")
+            return None
 
-        if latest_report is None:
+        # pypuppetdb's reports() takes no order-by or limit
+        reports = self.pdb._query('reports',
+                                  query=json.dumps(['=', 'certname', node.name]),
+                                  order_by=LATEST_REPORT_ORDER,
+                                  limit=1)
+        if len(reports) == 0:
             _log.info("Found no repots for node.")
             return None
+        latest_report = report_from_json(reports[0])
         _log.info("Found latest report for node %s; report hash %s" % (node.name, latest_report.hash_))
         _log.debug("Latest Report: Node=%s Hash=%s Start=%s End=%s Received=%s Version=%s Format=%s Agent_version=%s Run_time=%s" % (
                 latest_report.node,
@@ -88,11 +577,113 @@ class PuppetdbAgentRun(nagiosplugin.Resource):
                 latest_report.run_time))
         return latest_report
 
-    def probe(self):
+    def get_node_recent_reports(self, node, count):
+        """
+        For a puppetdb Node object, return its count latest reports as
+        ReportStubs, newest first, streamed from one query.
+        """
+        if node.report_timestamp is None:
+            return []
+        return list(stream_reports(self.pdb, json.dumps(['=', 'certname', node.name]),
+                                   order_by=LATEST_REPORT_ORDER, limit=count))
+
+    def latest_report(self):
         _log.info("finding node in PuppetDB")
         node = self.get_node_by_certname(self.hostname)
+        if self.regression:
+            # the latest report and the baseline runs in one listing
+            _log.info("finding latest %d reports" % (self.regression + 1))
+            self.history = self.get_node_recent_reports(node, self.regression + 1)
+            if len(self.history) == 0:
+                return None
+            return self.history[0]
         _log.info("finding latest report")
-        report = self.get_node_latest_report(node)
+        return self.get_node_latest_report(node)
+
+    def get_report_time_metrics(self, report):
+        """
+        Return (resource type, seconds) for each 'time' metric of a report
+        (not counting the run total), or an empty list if this PuppetDB
+        does not serve report metrics. Which of REPORT_METRICS_PATHS it
+        serves, if any, is remembered on pdb ('' for none).
+        """
+        known = self.pdb.recall('report_metrics_path')
+        if known is None:
+            paths = REPORT_METRICS_PATHS
+        else:
+            paths = [path for path in [known] if path]
+        for path in paths:
+            r = self.pdb.get(path % report.hash_)
+            if r.status_code == 404:
+                continue
+            r.raise_for_status()
+            if known is None:
+                self.pdb.remember('report_metrics_path', path)
+            return [(m['name'], m['value']) for m in r.json()
+                    if m['category'] == 'time' and m['name'] != 'total']
+        if known is None:
+            self.pdb.remember('report_metrics_path', '')
+        _log.info("PuppetDB serves no report metrics; using event timings only")
+        return []
+
+    def get_report_event_times(self, report):
+        """
+        Yield (seconds, 'Type[title]') for each event of a report: the time
+        since the previous event (or the start of the run), which is as
+        close as PuppetDB comes to how long the resource took.
+        """
+        previous = report.start
+        for e in stream_query(self.pdb, 'events', json.dumps(['=', 'report', report.hash_]),
+                              order_by=EVENT_ORDER):
+            timestamp = json_to_datetime(e['timestamp'])
+            yield (total_seconds(timestamp - previous), "%s[%s]" % (e['resource-type'], e['resource-title']))
+            previous = timestamp
+
+    def slowest_metrics(self, report):
+        """the slowest resource types and changed resources of the latest report, as perfdata"""
+        self.slowest_types = heapq.nlargest(self.slowest, self.get_report_time_metrics(report),
+                                            key=lambda pair: pair[1])
+        # a resource has an event per changed property; keep its longest
+        longest = {}
+        for seconds, name in self.get_report_event_times(report):
+            if seconds > longest.get(name, -1):
+                longest[name] = seconds
+        self.slowest_resources = heapq.nlargest(self.slowest, [(seconds, name) for name, seconds in longest.items()])
+        metrics = []
+        for name, seconds in self.slowest_types:
+            metrics.append(nagiosplugin.Metric('time_%s' % perf_label(name), round(seconds, 3), uom='s',
+                                               min=0, context='resource_time'))
+        for seconds, name in self.slowest_resources:
+            metrics.append(nagiosplugin.Metric(perf_label(name), round(seconds, 3), uom='s',
+                                               min=0, context='resource_time'))
+        return metrics
+
+    def regression_metrics(self, duration):
+        """
+        Compare the latest run's duration with the median of the runs
+        before it: the slowdown factor, and how many (MAD-estimated)
+        standard deviations above the median it is, 0 if below.
+        """
+        durations = [total_seconds(r.end - r.start) for r in self.history[1:]]
+        if len(durations) < REGRESSION_MIN_RUNS:
+            _log.info("only %d earlier runs; no duration baseline" % len(durations))
+            return []
+        baseline = median(durations)
+        mad = median([abs(d - baseline) for d in durations])
+        spread = max(MAD_SCALE * mad, REGRESSION_MIN_SPREAD * baseline, 1.0)
+        score = max((duration - baseline) / spread, 0)
+        slowdown = duration / baseline if baseline > 0 else 0
+        _log.info("duration baseline over %d runs: median %.1fs, MAD %.1fs; score %.2f, slowdown %.2fx" % (
+            len(durations), baseline, mad, score, slowdown))
+        return [
+            nagiosplugin.Metric('run_duration_baseline', round(baseline, 3), uom='s', min=0,
+                                context='run_duration_stats'),
+            nagiosplugin.Metric('run_slowdown', round(slowdown, 2), min=0, context='run_duration_stats'),
+            nagiosplugin.Metric('run_duration_score', round(score, 2), min=0),
+            ]
+
+    def probe(self):
+        report = self.latest_report()
         if report is None:
             _log.info("returning now, no reports found")
             return [
@@ -103,29 +694,130 @@ class PuppetdbAgentRun(nagiosplugin.Resource):
 
         # This can return any iterable. All values will be checked against the threasholds and report
         # perfdata metrics
-        age = (datetime.now(utc) - report.start)
-        # work with py26
-        try:
-            age = age.total_seconds()
-        except AttributeError:
-            age = (age.microseconds + (age.seconds + age.days * 24 * 3600) * 10**6) / 10**6
+        age = total_seconds(datetime.now(utc) - report.start)
         _log.info("last run age: %ds ; run start time: %s" % (age, report.start))
-        duration = (report.end - report.start)
-        # work with py26
-        try:
-            duration = duration.total_seconds()
-        except AttributeError:
-            duration = (duration.microseconds + (duration.seconds + duration.days * 24 * 3600) * 10**6) / 10**6
+        duration = total_seconds(report.end - report.start)
         _log.info("run duration: %ds" % duration)
-        return [
+        metrics = [
             nagiosplugin.Metric('last_run_age', age, uom='s', min=0),
             nagiosplugin.Metric('last_run_duration', duration, uom='s', min=0),
             ]
+        if self.regression:
+            metrics.extend(self.regression_metrics(duration))
+        if self.slowest:
+            metrics.extend(self.slowest_metrics(report))
+        return metrics
+
+class FleetNodeRun(PuppetdbAgentRun):
+    """One node of a --fleet run, checked against a report already fetched in bulk."""
+    def __init__(self, hostname, puppetdb, pdb, report):
+        super(FleetNodeRun, self).__init__(hostname, puppetdb, pdb)
+        self.report = report
+
+    def latest_report(self):
+        return self.report
+
+class PuppetdbFleet(nagiosplugin.Resource):
+    """
+    Checks the last run of every active node in PuppetDB with a few bulk
+    queries, and submits each node's result as a passive check.
+    """
+    def __init__(self, puppetdb, contexts, command_file, service, pdb=None):
+        self.puppetdb_host = puppetdb
+        if pdb is None:
+            pdb = puppetdb_api(puppetdb)
+        self.pdb = pdb
+        self.contexts = contexts
+        self.command_file = command_file
+        self.service = service
+        # reports queries sent, and how many of them were repeats
+        self.queries = 0
+        self.repeats = 0
+
+    def latest_reports(self):
+        """return a dict of certname to latest Report (None if it has none) for every active node"""
+        reports = {}
+        nodes = {}
+        reported = []
+        for node in self.pdb.nodes():
+            if node.deactivated:
+                continue
+            reports[node.name] = None
+            nodes[node.name] = node
+            if node.report_timestamp is not None:
+                reported.append(node.name)
+        _log.info("Found %d active nodes, %d with reports" % (len(reports), len(reported)))
+        for i in range(0, len(reported), FLEET_CHUNK):
+            chunk = reported[i:i + FLEET_CHUNK]
+            while chunk:
+                stubs = stream_reports(self.pdb,
+                                       json.dumps(['or'] + [['=', 'certname', c] for c in chunk]),
+                                       order_by=LATEST_REPORT_ORDER,
+                                       limit=FLEET_REPORTS_PER_NODE * len(chunk))
+                self.queries += 1
+                for stub in stubs:
+                    if reports.get(stub.node, True) is None:
+                        reports[stub.node] = stub
+                missing = [certname for certname in chunk if reports[certname] is None]
+                if len(missing) == len(chunk):
+                    # the newest report of the chunk would have been one
+                    # of theirs: their reports are gone since the listing
+                    _log.info("no reports stored for %s" % ", ".join(missing))
+                    break
+                if missing:
+                    _log.info("%d nodes crowded out of their chunk's newest reports; querying them again" %
+                              len(missing))
+                    self.repeats += 1
+                chunk = missing
+        return reports
+
+    def probe(self):
+        reports = self.latest_reports()
+        counts = [0, 0, 0, 0]
+        for certname in sorted(reports):
+            check = nagiosplugin.Check(FleetNodeRun(certname, self.puppetdb_host, self.pdb, reports[certname]),
+                                       LoadSummary(certname), *self.contexts)
+            check()
+            output = check.summary_str
+            if check.perfdata:
+                output += '|' + ' '.join(check.perfdata)
+            submit_result(self.command_file, certname, self.service, check.exitcode, output)
+            counts[check.exitcode] += 1
+        _log.info("submitted %d results to %s" % (len(reports), self.command_file))
+        return [nagiosplugin.Metric('nodes_%s' % name, count, min=0, context='fleet_nodes')
+                for name, count in zip(['ok', 'warning', 'critical', 'unknown'], counts)] + [
+            nagiosplugin.Metric('report_queries', self.queries, min=0, context='fleet_queries'),
+            nagiosplugin.Metric('report_repeats', self.repeats, min=0, context='fleet_queries')]
+
+class FleetSummary(nagiosplugin.Summary):
+    """status line for --fleet: how many results of each state were submitted"""
+    def __init__(self, command_file, pdb=None):
+        self.command_file = command_file
+        self.pdb = pdb
+
+    def ok(self, results):
+        if type(results.most_significant_state) == type(nagiosplugin.state.Unknown):
+            # won't have perf values, so special handling
+            return results.most_significant[0].hint.splitlines()[0]
+        counts = [results['nodes_%s' % name].metric.value for name in ['ok', 'warning', 'critical', 'unknown']]
+        return "submitted %d results to %s: %d ok, %d warning, %d critical, %d unknown (%d report queries, %d repeated)" % (
+            tuple([sum(counts), self.command_file] + counts) +
+            (results['report_queries'].metric.value, results['report_repeats'].metric.value))
+
+    def problem(self, results):
+        return self.ok(results)
+
+    def verbose(self, results):
+        lines = super(FleetSummary, self).verbose(results)
+        if self.pdb is not None:
+            lines.extend(self.pdb.latency_lines())
+        return lines
 
 class LoadSummary(nagiosplugin.Summary):
     """LoadSummary is used to provide custom outputs to the check"""
-    def __init__(self, hostname):
+    def __init__(self, hostname, pdb=None):
         self.hostname = hostname
+        self.pdb = pdb
 
     def _human_time(self, seconds):
         """convert an integer seconds into human-readable hms"""
@@ -144,13 +836,50 @@ class LoadSummary(nagiosplugin.Summary):
         return ""
 
     def status_line(self, results):
-        if results['last_run_age'].metric == -1:
+        if type(results.most_significant_state) == type(nagiosplugin.state.Unknown):
+            # won't have perf values, so special handling
+            return results.most_significant[0].hint.splitlines()[0]
+        if results['last_run_age'].metric.value == -1:
             return "%s - No reports found in PuppetDB. No record of any run." % self.hostname
-        return "%s - Last Run %s ago%s, Run Duration %s%s" %(self.hostname,
+        return "%s - Last Run %s ago%s, Run Duration %s%s%s" %(self.hostname,
                                                          self._human_time(results['last_run_age'].metric.value),
                                                          self._state_marker(results['last_run_age'].state),
                                                          self._human_time(results['last_run_duration'].metric.value),
-                                                         self._state_marker(results['last_run_duration'].state))
+                                                         self._state_marker(results['last_run_duration'].state),
+                                                         self.regression_line(results))
+
+    def regression_line(self, results):
+        """the latest run against its baseline, if --regression is on"""
+        if 'run_duration_score' not in results:
+            return ""
+        return ", %.1fx Median Duration %s%s" % (results['run_slowdown'].metric.value,
+                                         self._human_time(results['run_duration_baseline'].metric.value),
+                                         self._state_marker(results['run_duration_score'].state))
+
+    def slowest_lines(self, results):
+        """the slowest resource types and resources, with --slowest"""
+        for result in results:
+            if result.metric is not None and result.metric.context == 'resource_time':
+                run = result.resource
+                break
+        else:
+            return []
+        lines = []
+        if len(run.slowest_types) > 0:
+            lines.append("Slowest resource types: " + ", ".join(
+                ["%s %.1fs" % (name, seconds) for name, seconds in run.slowest_types]))
+        if len(run.slowest_resources) > 0:
+            lines.append("Slowest changed resources: " + ", ".join(
+                ["%s %.1fs" % (name, seconds) for seconds, name in run.slowest_resources]))
+        return lines
+
+    def verbose(self, results):
+        """long output: the slowest resources (--slowest) and how each PuppetDB replied"""
+        lines = super(LoadSummary, self).verbose(results)
+        lines.extend(self.slowest_lines(results))
+        if self.pdb is not None:
+            lines.extend(self.pdb.latency_lines())
+        return lines
 
     def ok(self, results):
         return self.status_line(results)
@@ -175,8 +904,48 @@ def main():
     parser.add_argument('-dc', '--duration-critical', dest='dur_critical',
                         default='900',
                         help='critical threshold for last run duration, in seconds (Default: 900 / 15m)')
-    parser.add_argument('-p', '--puppetdb', dest='puppetdb',
-                        help='PuppetDB hostname or IP address')
+    parser.add_argument('-r', '--regression', dest='regression', type=int,
+                        help='also compare the last run duration with the median of this many runs before '
+                        'it, and alert on an outlier (not with --fleet)')
+    parser.add_argument('-rw', '--regression-warning', dest='regression_warning',
+                        default='3.5',
+                        help='warning threshold for how many standard deviations (estimated from the median '
+                        'absolute deviation) the last run took longer than the median (Default: 3.5)')
+    parser.add_argument('-rc', '--regression-critical', dest='regression_critical',
+                        default='6',
+                        help='critical threshold for how many standard deviations the last run took longer '
+                        'than the median (Default: 6)')
+    parser.add_argument('-s', '--slowest', dest='slowest', type=int,
+                        help='also list this many slowest resource types (from the report\'s time '
+                        'metrics, PuppetDB 3+) and changed resources (from event timestamps) of the '
+                        'last run, in the long output (-v) and perfdata')
+    parser.add_argument('-p', '--puppetdb', dest='puppetdb', action='append',
+                        help='PuppetDB hostname or IP address, optionally with :port; give several '
+                        '(repeated or comma-separated) to query replicas, hedged')
+    parser.add_argument('--hedge-percentile', dest='hedge_percentile', type=float,
+                        default=HEDGE_PERCENTILE,
+                        help='with several PuppetDBs, also ask the next one when a request has taken '
+                        'longer than this percentile of the last one\'s reply times; --cache keeps them '
+                        'between runs (Default: %s)' % HEDGE_PERCENTILE)
+    parser.add_argument('--hedge-delay', dest='hedge_delay', type=float,
+                        default=HEDGE_DELAY,
+                        help='seconds to wait instead while a PuppetDB has replied fewer than %d times '
+                        '(Default: %s)' % (HEDGE_MIN_SAMPLES, HEDGE_DELAY))
+    parser.add_argument('--fleet', dest='fleet', action='store_true', default=False,
+                        help='check every active node in PuppetDB at once, with a few bulk queries, and '
+                        'submit each result as a passive check to --command-file instead of checking -H')
+    parser.add_argument('--command-file', dest='command_file',
+                        default='/var/icinga/rw/icinga.cmd',
+                        help='Nagios/Icinga external command file for --fleet (Default: /var/icinga/rw/icinga.cmd)')
+    parser.add_argument('--service', dest='service',
+                        default='puppet agent run',
+                        help='service description to submit --fleet results for (Default: puppet agent run)')
+    parser.add_argument('--cache', dest='cache',
+                        help='SQLite file to share PuppetDB responses in between checks running on this '
+                        'host, e.g. /var/tmp/check_puppetdb_agent_run.db (Default: no cache)')
+    parser.add_argument('--cache-ttl', dest='cache_ttl', type=float,
+                        default=60,
+                        help='seconds a cached PuppetDB response is used for (Default: 60)')
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help='increase output verbosity (use up to 3 times)')
     parser.add_argument('-t', '--timeout', dest='timeout',
@@ -185,17 +954,39 @@ def main():
 
     args = parser.parse_args()
 
-    if not args.hostname:
+    if not args.hostname and not args.fleet:
         raise nagiosplugin.CheckError('hostname (-H|--hostname) must be provided')
 
     if not args.puppetdb:
         raise nagiosplugin.CheckError('PuppetDB host/IP (-p|--puppetdb) must be provided')
+    puppetdb = ','.join(args.puppetdb)
 
-    check = nagiosplugin.Check(
-        PuppetdbAgentRun(args.hostname, args.puppetdb),
+    if args.fleet and args.regression:
+        raise nagiosplugin.CheckError('-r|--regression needs a query per node, so cannot be used with --fleet')
+    if args.fleet and args.slowest:
+        raise nagiosplugin.CheckError('-s|--slowest needs a query per node, so cannot be used with --fleet')
+
+    contexts = [
         nagiosplugin.ScalarContext('last_run_age', args.last_warning, args.last_critical),
         nagiosplugin.ScalarContext('last_run_duration', args.dur_warning, args.dur_critical),
-        LoadSummary(args.hostname))
+        nagiosplugin.ScalarContext('run_duration_score', args.regression_warning, args.regression_critical),
+        nagiosplugin.ScalarContext('run_duration_stats'),
+        nagiosplugin.ScalarContext('resource_time'),
+        ]
+
+    pdb = puppetdb_api(puppetdb, args.cache, args.cache_ttl, args.hedge_percentile, args.hedge_delay)
+
+    if args.fleet:
+        check = nagiosplugin.Check(
+            PuppetdbFleet(puppetdb, contexts, args.command_file, args.service, pdb),
+            nagiosplugin.ScalarContext('fleet_nodes'),
+            nagiosplugin.ScalarContext('fleet_queries'),
+            FleetSummary(args.command_file, pdb))
+    else:
+        check = nagiosplugin.Check(
+            PuppetdbAgentRun(args.hostname, puppetdb, pdb, args.regression, args.slowest),
+            LoadSummary(args.hostname, pdb),
+            *contexts)
 
     check.main(args.verbose, args.timeout)
 